@@ -1,17 +1,36 @@
 #!./venv/bin/python
 
+import time
+STARTUP_TIMES = {"start":time.perf_counter()}
+
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+import flask
+STARTUP_TIMES["dash imported"] = time.perf_counter()
 
-import datetime, sys, os
+import datetime, sys, os, threading
 
+# The archive and plotting modules import pandas, that is left to warm_up
 from sensor import Sensor
-from measurer import MeasurementsArchive
-from plotter import Plotter
+from watcher import ArchiveWatcher
+from broadcaster import SampleBroadcaster
+
+def warming_up_figure():
+  return {
+    "data":[],
+    "layout":{
+      "xaxis":{"visible":False},
+      "yaxis":{"visible":False},
+      "annotations":[{"text":"Loading the measurements...", "font":{"size":24}, "xref":"paper", "yref":"paper", "x":0.5, "y":0.5, "showarrow":False}]
+    }
+  }
 
 def app_layout():
+  # Called for every page load, so that pages opened before the archive is loaded know to wait for it
+  ready = READY.is_set()
   return html.Div(
     [
       html.Div(
@@ -61,24 +80,93 @@ def app_layout():
       dcc.Graph(
         id='graph',
         responsive=True,
-        className="graph"
+        className="graph",
+        **({} if ready else {"figure":warming_up_figure()})
       ),
+      dcc.Interval(
+        id="warm-up",
+        interval=1000,
+        disabled=ready
+      ),
+      dcc.Store(id="ready", data=ready),
+      # New samples are pushed through /events, the refresher is only a fallback
       dcc.Interval(
         id="refresher",
-        interval=20*1000
-      )
+        interval=60*1000
+      ),
+      dcc.Store(id="live-sample"),
+      # The data of the presets, drawn in the browser by assets/live.js
+      dcc.Store(id="live-data"),
+      dcc.Store(id="live-state"),
+      dcc.Store(id="live-update"),
+      dcc.Store(id="live-revision"),
+      dcc.Store(id="graph-width")
     ],
     className="container"
   )
 
-ARCHIVE = MeasurementsArchive(os.environ.get("MEASUREMENTS_PATH") or "./test-data")
-ARCHIVE.open()
-PLOTTER = Plotter(ARCHIVE)
+if __name__ == '__main__' and len(sys.argv) == 2:
+  ARCHIVE_PATH = sys.argv[1]
+else:
+  ARCHIVE_PATH = os.environ.get("MEASUREMENTS_PATH") or "./test-data"
+# The archive is opened in the background by warm_up, the server answers meanwhile
+ARCHIVE = None
+PLOTTER = None
+BROADCASTER = None
+READY = threading.Event()
+
+def make_plotter(archive):
+  from plotter import Plotter, SharedFigureCache
+  # Figures are shared with the other processes serving the same archive, e.g. several gunicorn workers
+  return Plotter(archive, shared_figures=SharedFigureCache(SharedFigureCache.path_for(archive.archive_path)))
+
+def start_watcher(archive):
+  if not ArchiveWatcher.available():
+    print("inotify not available, the archive will be checked for changes on every refresh")
+    return None
+  watcher = ArchiveWatcher(archive)
+  try:
+    watcher.start()
+  except OSError as e:
+    print(f"Cannot watch the archive, it will be checked for changes on every refresh: {e}")
+    return None
+  return watcher
+
+WATCHER = None
+
+def start_broadcaster(archive):
+  broadcaster = SampleBroadcaster(archive, Sensor.Parameters)
+  broadcaster.start()
+  return broadcaster
+
+# Idle connections get a comment now and then, so that proxies do not close them
+EVENTS_KEEPALIVE = 15
+
+# More than a couple of points per horizontal pixel cannot be told apart
+POINTS_PER_PIXEL = 2
 
 app = dash.Dash(__name__)
-app.layout = app_layout()
+app.layout = app_layout
 server = app.server
 
+@server.route("/events")
+def events():
+  if not READY.is_set():
+    # The browser connects again after the retry interval
+    return flask.Response("retry: 1000\n\n", mimetype="text/event-stream", headers={"Cache-Control":"no-cache"})
+
+  def stream(sample_number):
+    yield "retry: 1000\n\n"
+    while True:
+      latest = BROADCASTER.wait(sample_number, timeout=EVENTS_KEEPALIVE)
+      if latest is None:
+        yield ": keepalive\n\n"
+        continue
+      sample_number = latest
+      yield f"data: {sample_number}\n\n"
+  return flask.Response(stream(BROADCASTER.sample_number), mimetype="text/event-stream",
+                        headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+
 @app.callback(
   Output("refresher", "disabled"),
   Output("custom-period-picker", "disabled"),
@@ -92,39 +180,71 @@ def change_refresh_method(period_selection):
   Output("custom-period-picker", "max_date_allowed"),
   Output("custom-period-picker", "start_date"),
   Output("custom-period-picker", "end_date"),
-  Input("refresher", "n_intervals")
+  Input("refresher", "n_intervals"),
+  Input("ready", "data")
 )
-def update_custom_period_picker(_):
-  min_date=ARCHIVE.archive_start()
-  max_date=datetime.datetime(ARCHIVE.archive_end().year, ARCHIVE.archive_end().month, ARCHIVE.archive_end().day)
+def update_custom_period_picker(_, ready):
+  if not ready or not READY.is_set():
+    raise PreventUpdate
+  # Until the measurer writes the first entry the archive is empty
+  now=datetime.datetime.now()
+  min_date=ARCHIVE.archive_start() or now
+  archive_end=ARCHIVE.archive_end() or now
+  max_date=datetime.datetime(archive_end.year, archive_end.month, archive_end.day)
   return [
     min_date,
     max_date,
-    datetime.datetime.now() - datetime.timedelta(hours=24),
-    datetime.datetime.now()
+    now - datetime.timedelta(hours=24),
+    now
   ]
 
+app.clientside_callback(
+  """
+  function(_) {
+    var graph = document.getElementById("graph");
+    return graph && graph.offsetWidth ? graph.offsetWidth : window.innerWidth;
+  }
+  """,
+  Output("graph-width", "data"),
+  Input("graph", "id")
+)
+
 @app.callback(
-  Output("graph", "figure"),
-  Input("refresher", "n_intervals"),
-  Input("period-inputlist", "value"),
-  Input("parameters-inputlist", "value"),
-  Input("custom-period-picker", "start_date"),
-  Input("custom-period-picker", "end_date"),
+  Output("ready", "data"),
+  Output("warm-up", "disabled"),
+  Input("warm-up", "n_intervals"),
+  prevent_initial_call=True
 )
-def update_plot(_, period_selection, parameter_selection, custom_start, custom_end):
-  print("update_plot")
-  if not ARCHIVE.is_open():
-    print("Archive not open upon refresh, trying to open it now")
-    ARCHIVE.open()
-  ARCHIVE.refresh()
-  print(f"After refresh {ARCHIVE.archive_entries}")
-  if period_selection == "last24":
-    end = datetime.datetime.now()
-    start = end - datetime.timedelta(hours=24)
-  if period_selection == "last12":
+def check_warm_up(_):
+  if not READY.is_set():
+    raise PreventUpdate
+  return True, True
+
+def visible_window(relayout_data):
+  # The x axis range the range slider was dragged to, as reported in the graph's relayoutData.
+  # Only called once warm_up has imported the plotter.
+  from plotter import Plotter
+  if not relayout_data:
+    return None
+  if "xaxis.range" in relayout_data:
+    window_start, window_end = relayout_data["xaxis.range"]
+  elif "xaxis.range[0]" in relayout_data and "xaxis.range[1]" in relayout_data:
+    window_start, window_end = relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]
+  else:
+    return None
+  return (Plotter.parse_time(window_start), Plotter.parse_time(window_end))
+
+PRESETS = {
+  "last12":datetime.timedelta(hours=12),
+  "last24":datetime.timedelta(hours=24)
+}
+# The browser keeps the data of the longest preset and switches between them by itself
+LIVE_SPAN = max(PRESETS.values())
+
+def period_span(period_selection, custom_start, custom_end):
+  if period_selection in PRESETS:
     end = datetime.datetime.now()
-    start = end - datetime.timedelta(hours=12)
+    start = end - PRESETS[period_selection]
   else:
     print(f"Custom start:{custom_start}, end:{custom_end}")
     end=datetime.datetime.fromisoformat(custom_end)
@@ -132,14 +252,166 @@ def update_plot(_, period_selection, parameter_selection, custom_start, custom_e
     if end.hour == end.minute == end.second == 0:
       end = end + datetime.timedelta(hours=23, minutes=59, seconds=59)
       print(f"Adjusting custom_end to: {end.isoformat()}")
+  return start, end
 
-  return PLOTTER.get_plot(start, end, parameter_selection)
+def selected_parameters(parameter_selection):
+  # Always in the same order, so that every selection has one figure layout
+  return [parameter for parameter in Sensor.Decorations if parameter in parameter_selection]
 
-if __name__ == '__main__':
-  if len(sys.argv) == 2:
-    ARCHIVE = MeasurementsArchive(sys.argv[1])
+def refresh_archive():
+  if not ARCHIVE.is_open():
+    print("Archive not open upon refresh, trying to open it now")
     ARCHIVE.open()
-    PLOTTER = Plotter(ARCHIVE)
+  if ARCHIVE.is_open():
+    ARCHIVE.refresh()
+
+def max_points_for(graph_width):
+  return int(graph_width*POINTS_PER_PIXEL) if graph_width else PLOTTER.max_points
 
-  print(f"Launching server for archive in: {ARCHIVE.archive_path},\n{ARCHIVE.archive_entries}")
-  app.run(host='0.0.0.0', debug=False)
+@app.callback(
+  Output("graph", "figure"),
+  Input("period-inputlist", "value"),
+  Input("parameters-inputlist", "value"),
+  Input("custom-period-picker", "start_date"),
+  Input("custom-period-picker", "end_date"),
+  Input("graph-width", "data"),
+  Input("graph", "relayoutData"),
+  Input("ready", "data"),
+)
+def update_plot(period_selection, parameter_selection, custom_start, custom_end, graph_width, relayout_data, ready):
+  print("update_plot")
+  if not ready or not READY.is_set():
+    raise PreventUpdate
+  # Changes other than zooming start again from the overview
+  triggered_id = dash.callback_context.triggered_id
+  window = visible_window(relayout_data) if triggered_id == "graph" else None
+  if triggered_id == "graph" and window is None and not (relayout_data or {}).get("xaxis.autorange"):
+    raise PreventUpdate
+  # The presets are drawn in the browser, only zooming into them needs the server
+  if period_selection in PRESETS and triggered_id != "graph":
+    raise PreventUpdate
+  refresh_archive()
+  print(f"After refresh {ARCHIVE.archive_entries}")
+  start, end = period_span(period_selection, custom_start, custom_end)
+  return PLOTTER.get_plot(start, end, selected_parameters(parameter_selection), max_points_for(graph_width), window)
+
+# Live data by point budget, handed to every client until new data comes in. warm_up makes the default one.
+LIVE_DATA = {}
+LIVE_DATA_LOCK = threading.Lock()
+
+def data_version():
+  # The same in every worker serving the archive, as a list like the live state comes back from the browser
+  return list(ARCHIVE.data_stamp())
+
+def load_live_data(max_points):
+  version = data_version()
+  with LIVE_DATA_LOCK:
+    cached = LIVE_DATA.get(max_points)
+  if cached is not None and cached[1]["version"] == version:
+    return cached
+  end = datetime.datetime.now()
+  data, state = PLOTTER.live_data(end - LIVE_SPAN, end, list(Sensor.Decorations), max_points)
+  data["presets"] = {period:span.total_seconds()*1000 for period, span in PRESETS.items()}
+  data["span"] = LIVE_SPAN.total_seconds()*1000
+  state["version"] = version
+  live_data = (data, state, end.isoformat())
+  with LIVE_DATA_LOCK:
+    # Only the latest data is worth keeping
+    for key in [key for key, (_, cached_state, _) in LIVE_DATA.items() if cached_state["version"] != version]:
+      del LIVE_DATA[key]
+    LIVE_DATA[max_points] = live_data
+  return live_data
+
+@app.callback(
+  Output("live-data", "data"),
+  Output("live-state", "data"),
+  Output("live-revision", "data"),
+  Input("period-inputlist", "value"),
+  Input("graph-width", "data"),
+  Input("ready", "data"),
+  State("live-state", "data"),
+)
+def update_live_data(period_selection, graph_width, ready, live_state):
+  # Loaded once for a preset and then only updated, unless the graph gets wider or narrower
+  if not ready or not READY.is_set() or period_selection not in PRESETS:
+    raise PreventUpdate
+  max_points = max_points_for(graph_width)
+  if live_state is not None and live_state["max_points"] == max_points:
+    raise PreventUpdate
+  refresh_archive()
+  return load_live_data(max_points)
+
+@app.callback(
+  Output("live-update", "data"),
+  Output("live-state", "data", allow_duplicate=True),
+  Output("live-data", "data", allow_duplicate=True),
+  Output("live-revision", "data", allow_duplicate=True),
+  Input("refresher", "n_intervals"),
+  Input("live-sample", "data"),
+  State("live-state", "data"),
+  prevent_initial_call=True
+)
+def send_live_update(_, __, live_state):
+  # New samples are sent on their own and added to the live data in the browser
+  if not READY.is_set():
+    raise PreventUpdate
+  refresh_archive()
+  if live_state is None or live_state["version"] == data_version():
+    raise PreventUpdate
+  end = datetime.datetime.now()
+  update = PLOTTER.live_update(live_state, end - LIVE_SPAN, end)
+  if update is None:
+    return (dash.no_update,) + load_live_data(live_state["max_points"])
+  live_update, live_state = update
+  live_state["version"] = data_version()
+  return live_update if live_update is not None else dash.no_update, live_state, dash.no_update, dash.no_update
+
+app.clientside_callback(
+  ClientsideFunction(namespace="live", function_name="render"),
+  Output("graph", "figure", allow_duplicate=True),
+  Input("period-inputlist", "value"),
+  Input("parameters-inputlist", "value"),
+  Input("live-revision", "data"),
+  State("live-data", "data"),
+  prevent_initial_call=True
+)
+
+app.clientside_callback(
+  ClientsideFunction(namespace="live", function_name="update"),
+  Output("live-data", "data", allow_duplicate=True),
+  Output("graph", "extendData"),
+  Output("graph", "figure", allow_duplicate=True),
+  Input("live-update", "data"),
+  State("live-data", "data"),
+  State("period-inputlist", "value"),
+  State("parameters-inputlist", "value"),
+  State("graph", "figure"),
+  prevent_initial_call=True
+)
+
+def warm_up():
+  global ARCHIVE, PLOTTER, WATCHER, BROADCASTER
+  started = time.perf_counter()
+  from measurer import MeasurementsArchive
+  imported = time.perf_counter()
+  ARCHIVE = MeasurementsArchive(ARCHIVE_PATH, read_only=True)
+  ARCHIVE.open()
+  PLOTTER = make_plotter(ARCHIVE)
+  opened = time.perf_counter()
+  WATCHER = start_watcher(ARCHIVE)
+  BROADCASTER = start_broadcaster(ARCHIVE)
+  # The default live data is made once, the first client gets it as it is
+  load_live_data(PLOTTER.max_points)
+  plotted = time.perf_counter()
+  READY.set()
+  print(f"Startup took {plotted-STARTUP_TIMES['start']:.2f}s: "
+        f"importing dash {STARTUP_TIMES['dash imported']-STARTUP_TIMES['start']:.2f}s, "
+        f"importing the archive modules {imported-started:.2f}s, "
+        f"opening the archive {opened-imported:.2f}s, "
+        f"first plot {plotted-opened:.2f}s")
+
+threading.Thread(target=warm_up, daemon=True).start()
+
+if __name__ == '__main__':
+  print(f"Launching server for archive in: {ARCHIVE_PATH}")
+  app.run(host='0.0.0.0', debug=False, threaded=True)
@@ -0,0 +1,132 @@
+// Tells the dashboard about every new sample as soon as the server announces it
+if (window.EventSource) {
+  var liveEvents = new EventSource("/events");
+  liveEvents.onmessage = function(event) {
+    if (window.dash_clientside && dash_clientside.set_props) {
+      dash_clientside.set_props("live-sample", {data: Number(event.data)});
+    }
+  };
+}
+
+// Draws the presets from the live data the server sent once, see Plotter.live_data
+(function() {
+  function decode(values) {
+    // Plotly's base64 typed arrays become plain arrays, so that new samples can be appended
+    if (!values || Array.isArray(values)) {
+      return values || [];
+    }
+    var bytes = atob(values.bdata);
+    var view = new Uint8Array(bytes.length);
+    for (var i = 0; i < bytes.length; i++) {
+      view[i] = bytes.charCodeAt(i);
+    }
+    return Array.from(new Float64Array(view.buffer));
+  }
+
+  function firstIndex(x, start) {
+    var low = 0, high = x.length;
+    while (low < high) {
+      var middle = (low + high) >> 1;
+      if (x[middle] < start) {
+        low = middle + 1;
+      } else {
+        high = middle;
+      }
+    }
+    return low;
+  }
+
+  function selected(data, parameters) {
+    return data.parameters.filter(function(parameter) { return parameters.indexOf(parameter) >= 0; });
+  }
+
+  function figure(data, period, parameters) {
+    var selection = selected(data, parameters);
+    var start = data.end - data.presets[period];
+    var points = {};
+    var count = 0;
+    var traces = selection.map(function(parameter) {
+      var x = decode(data.x[parameter]), y = decode(data.y[parameter]);
+      var first = firstIndex(x, start);
+      points[parameter] = x.length - first;
+      count += points[parameter];
+      return {x: x.slice(first), y: y.slice(first)};
+    });
+    if (count === 0) {
+      return {data: [], layout: Object.assign({}, data.empty_layout, {template: data.template})};
+    }
+
+    // Each parameter brings its axis and trace, placed by the position it has in the selection
+    var positions = data.positions[selection.length - 1];
+    var layout = Object.assign({}, data.layout, {
+      template: data.template,
+      meta: {resolution: data.resolution, points: points}
+    });
+    traces = traces.map(function(trace, i) {
+      var parameter = selection[i];
+      var finite = trace.y.filter(function(value) { return value !== null && isFinite(value); });
+      var min = Math.min.apply(null, finite), max = Math.max.apply(null, finite);
+      // Plotly calls the first y axis just yaxis
+      var axis = i === 0 ? "yaxis" : "yaxis" + (i + 1);
+      layout[axis] = Object.assign({}, data.axes[parameter], positions[i], {tick0: min, dtick: (max - min)/(data.y_axis_ticks - 1)});
+      return Object.assign({}, data.traces[parameter], {yaxis: i === 0 ? "y" : "y" + (i + 1)}, trace);
+    });
+    return {data: traces, layout: layout};
+  }
+
+  window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    live: {
+      render: function(period, parameters, revision, data) {
+        if (!data || !(period in data.presets)) {
+          return window.dash_clientside.no_update;
+        }
+        return figure(data, period, parameters);
+      },
+
+      update: function(update, data, period, parameters, shown) {
+        var no_update = window.dash_clientside.no_update;
+        if (!update || !data) {
+          return [no_update, no_update, no_update];
+        }
+        // The new samples are added and whatever is older than the longest preset dropped
+        var keep = update.end - data.span;
+        var x = {}, y = {};
+        data.parameters.forEach(function(parameter) {
+          var parameterX = decode(data.x[parameter]).concat(update.x[parameter]);
+          var parameterY = decode(data.y[parameter]).concat(update.y[parameter]);
+          var first = firstIndex(parameterX, keep);
+          x[parameter] = parameterX.slice(first);
+          y[parameter] = parameterY.slice(first);
+        });
+        var previous = data;
+        data = Object.assign({}, data, {x: x, y: y, end: update.end});
+        if (!(period in data.presets)) {
+          return [data, no_update, no_update];
+        }
+
+        // Traces only get the new samples, as many old ones as have left the preset are dropped
+        var selection = selected(data, parameters);
+        var start = data.end - data.presets[period];
+        var previousStart = previous.end - previous.presets[period];
+        var empty = selection.every(function(parameter) {
+          var previousX = decode(previous.x[parameter]);
+          return firstIndex(previousX, previousStart) === previousX.length;
+        });
+        if (empty || !shown || !shown.data || shown.data.length !== selection.length) {
+          return [data, no_update, figure(data, period, parameters)];
+        }
+        // The shown traces may hold more points than the live data, when the server drew a zoomed in
+        // window, so what is kept is counted on them
+        var extension = {x: [], y: []}, indices = [], maxPoints = [];
+        selection.forEach(function(parameter, i) {
+          var shownX = decode(shown.data[i].x);
+          extension.x.push(update.x[parameter]);
+          extension.y.push(update.y[parameter]);
+          indices.push(i);
+          maxPoints.push(shownX.length - firstIndex(shownX, start) + update.x[parameter].length);
+        });
+        return [data, [extension, indices, {x: maxPoints, y: maxPoints}], no_update];
+      }
+    }
+  });
+})();
@@ -0,0 +1,67 @@
+import os, threading
+
+from livestatus import LiveStatus
+
+class SampleBroadcaster(threading.Thread):
+  # Follows the live status the measurer publishes and wakes up everybody waiting for a new sample,
+  # so that any number of clients can wait for samples while only this thread watches the status.
+  RETRY_INTERVAL=1
+
+  def __init__(self, archive, parameters):
+    threading.Thread.__init__(self, daemon=True)
+    self.archive=archive
+    self.path=LiveStatus.path_for(archive.archive_path)
+    self.parameters=parameters
+    self.live_status=None
+    self.inode=None
+    self.sample_number=0
+    self.condition=threading.Condition()
+    self.stop_event=threading.Event()
+
+  def open(self):
+    live_status=LiveStatus(self.path, self.parameters)
+    live_status.open()
+    self.live_status=live_status
+    self.inode=os.stat(self.path).st_ino
+    sample=live_status.read()
+    with self.condition:
+      self.sample_number=max(self.sample_number, sample[0] if sample else 0)
+
+  def replaced(self):
+    # A measurer started after the status file was removed writes to a new file
+    try:
+      return os.stat(self.path).st_ino != self.inode
+    except FileNotFoundError:
+      return True
+
+  def run(self):
+    while not self.stop_event.is_set():
+      if self.live_status is None:
+        try:
+          self.open()
+        except (FileNotFoundError, ValueError):
+          self.stop_event.wait(self.RETRY_INTERVAL)
+          continue
+      sample=self.live_status.wait(self.sample_number, timeout=self.RETRY_INTERVAL)
+      if sample is None:
+        if self.replaced():
+          self.live_status.close()
+          self.live_status=None
+        continue
+      # The sample is in the archive already, it does not have to wait for the watcher to notice
+      self.archive.changes_pending=True
+      with self.condition:
+        self.sample_number=sample[0]
+        self.condition.notify_all()
+    if self.live_status is not None:
+      self.live_status.close()
+
+  def wait(self, sample_number, timeout=None):
+    # Returns the number of the latest sample once it is newer than sample_number, or None on timeout
+    with self.condition:
+      if self.condition.wait_for(lambda: self.sample_number > sample_number, timeout):
+        return self.sample_number
+    return None
+
+  def stop(self):
+    self.stop_event.set()
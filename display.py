@@ -2,10 +2,10 @@ import os
 import time
 from datetime import datetime
 import threading
-import json
 
 from hd44780_over_pcf8574 import HD44780
 from sensor import Sensor
+from livestatus import LiveStatus
 
 class Display(threading.Thread):
   COLUMNS = 2
@@ -23,7 +23,7 @@ class Display(threading.Thread):
 
   def __init__(self, lcd, archive_path):
     self.lcd = lcd
-    self.measurer_status_path = os.path.join(archive_path, "status.json")
+    self.live_status = LiveStatus(LiveStatus.path_for(archive_path), Sensor.Parameters)
     self.init_display()
     self.init_elements()
 
@@ -93,12 +93,17 @@ class Display(threading.Thread):
     self.lcd.clear()
     self.lcd.print("Waiting for data...")
     last_reinit = datetime.min
+    sample = None
 
     while(True):
       try:
-        with open(self.measurer_status_path) as measurer_status:
-          json_dict = json.load(measurer_status)
-          timestamp = datetime.fromisoformat(json_dict["time"])
+        if self.live_status.map is None:
+          self.live_status.open()
+        # Wakes up for new samples, and at least every second to blink the clock
+        sample = self.live_status.wait(sample[0] if sample else 0, timeout=1) or sample
+        if sample is None:
+          continue
+        _, timestamp, values = sample
         now = datetime.now()
         is_alive = (now - timestamp).total_seconds() < 120
         needs_reinit = (now - last_reinit).total_seconds() > 60
@@ -115,14 +120,14 @@ class Display(threading.Thread):
           time_element.set_text(timestamp.strftime("%H:%M"))
 
         for element in self.elements[1:]:
-          element.set_text(json_dict[element.key])
+          element.set_text(values[element.key])
 
         self.redraw()
-      except json.JSONDecodeError:
-        print(f"Empty measurer status file {self.measurer_status_path}, will retry")
-      except FileNotFoundError:
-        print(f"No measurer status file {self.measurer_status_path}, will retry")
-      time.sleep(1)
+      except (FileNotFoundError, ValueError) as error:
+        # The measurer may not have started yet, or be setting the file up right now
+        print(f"No measurer status in {self.live_status.path}, will retry: {error}")
+        self.live_status.close()
+        time.sleep(1)
 
 if __name__ == "__main__":
   archive_path = os.environ.get("MEASUREMENTS_PATH")
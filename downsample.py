@@ -0,0 +1,52 @@
+import numpy as np
+
+def lttb(x, y, threshold):
+  # Largest-Triangle-Three-Buckets, returns indices of the points to keep. Bucket averages are
+  # computed for all buckets at once, only choosing the point of each bucket is sequential.
+  n=len(x)
+  if threshold >= n or threshold < 3:
+    return np.arange(n)
+
+  x=np.asarray(x, dtype=np.float64) - float(x[0])
+  y=np.asarray(y, dtype=np.float64)
+
+  # First and last points are kept as they are, the rest is split into threshold-2 buckets
+  edges=np.unique(np.linspace(1, n-1, threshold-1).astype(np.int64))
+  counts=np.diff(edges)
+  average_x=np.add.reduceat(x[:-1], edges[:-1])/counts
+  average_y=np.add.reduceat(y[:-1], edges[:-1])/counts
+  # The point following each bucket is chosen against the average of the next one, or the last point
+  next_x=np.append(average_x[1:], x[-1])
+  next_y=np.append(average_y[1:], y[-1])
+
+  selected=np.empty(len(counts)+2, dtype=np.int64)
+  selected[0]=0
+  selected[-1]=n-1
+  a=0
+  for i in range(len(counts)):
+    lo, hi=edges[i], edges[i+1]
+    area=np.abs((x[a]-next_x[i])*(y[lo:hi]-y[a]) - (x[a]-x[lo:hi])*(next_y[i]-y[a]))
+    a=lo+int(np.argmax(area))
+    selected[i+1]=a
+  return selected
+
+def minmax(x, y, threshold):
+  # Keeps the lowest and the highest point of every bucket, in the order they occur
+  n=len(x)
+  if threshold >= n or threshold < 4:
+    return np.arange(n)
+  edges=np.unique(np.linspace(0, n, threshold//2+1).astype(np.int64))
+  y=np.asarray(y, dtype=np.float64)
+  bucket=np.repeat(np.arange(len(edges)-1), np.diff(edges))
+  order=np.lexsort((y, bucket))
+  lowest=order[edges[:-1]]
+  highest=order[edges[1:]-1]
+  return np.unique(np.concatenate([lowest, highest]))
+
+def downsample(x, y, threshold, method=lttb):
+  # Drops missing values and returns the kept (x, y), peaks and dips stay visible with both methods
+  y=np.asarray(y, dtype=np.float64)
+  finite=np.isfinite(y)
+  x, y=np.asarray(x)[finite], y[finite]
+  indices=method(x.view(np.int64) if x.dtype.kind == "M" else x, y, threshold)
+  return x[indices], y[indices]
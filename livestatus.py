@@ -0,0 +1,140 @@
+import datetime, hashlib, mmap, os, select, struct, time
+
+from watcher import ArchiveWatcher, inotify_watch, IN_CLOEXEC, IN_NONBLOCK
+
+class LiveStatus:
+  # The latest measurement in a small memory mapped file, guarded by a seqlock: the writer makes the
+  # sequence odd while it updates the record and even again when done, readers retry until they copy
+  # the record with the same even sequence on both sides. Writes to the map are invisible to inotify, so
+  # the writer touches the file after each sample and waiting readers sleep until inotify reports it.
+  Header=struct.Struct("<QqII")  # sequence, time in ns, number of values, pid of the writer
+  IN_ATTRIB=0x00000004
+  POLL_INTERVAL=1
+  # Updates take microseconds, a sequence which stays odd longer is left by a writer which died meanwhile
+  READ_TIMEOUT=0.1
+  MAX_RETRY_DELAY=0.01
+
+  def __init__(self, path, parameters):
+    self.path=path
+    self.parameters=parameters
+    self.values=struct.Struct(f"<{len(parameters)}d")
+    self.size=self.Header.size + self.values.size
+    self.map=None
+    self.notifications=None
+    self.last_sample=None
+
+  @classmethod
+  def path_for(cls, archive_path):
+    name=hashlib.sha1(os.path.abspath(archive_path).encode()).hexdigest()[:12]
+    if os.path.isdir("/dev/shm"):
+      return os.path.join("/dev/shm", f"environment-monitor-{name}")
+    return os.path.join(archive_path, "status.shm")
+
+  def map_file(self, flags, access):
+    fd=os.open(self.path, flags, 0o644)
+    try:
+      if access == mmap.ACCESS_WRITE and os.fstat(fd).st_size != self.size:
+        os.ftruncate(fd, self.size)
+      elif os.fstat(fd).st_size != self.size:
+        raise ValueError(f"{self.path} does not hold {len(self.parameters)} values")
+      self.map=mmap.mmap(fd, self.size, access=access)
+    finally:
+      os.close(fd)
+
+  def create(self):
+    self.map_file(os.O_RDWR | os.O_CREAT, mmap.ACCESS_WRITE)
+    sequence, time_ns, count, pid=self.Header.unpack_from(self.map)
+    if pid != 0 and pid != os.getpid() and self.process_alive(pid):
+      print(f"{self.path} is being written by process {pid}! This might mean there are two instances running.")
+    # Continuing the sequence keeps it increasing for readers which mapped the file before a restart
+    sequence+=sequence % 2
+    self.Header.pack_into(self.map, 0, sequence, time_ns, len(self.parameters), os.getpid())
+
+  def open(self):
+    self.map_file(os.O_RDONLY, mmap.ACCESS_READ)
+
+  @staticmethod
+  def process_alive(pid):
+    try:
+      os.kill(pid, 0)
+    except ProcessLookupError:
+      return False
+    except PermissionError:
+      pass
+    return True
+
+  def sequence(self):
+    return struct.unpack_from("<Q", self.map)[0]
+
+  def publish(self, measurement, time):
+    sequence=self.sequence()
+    struct.pack_into("<Q", self.map, 0, sequence+1)
+    self.values.pack_into(self.map, self.Header.size, *measurement)
+    struct.pack_into("<q", self.map, 8, int(datetime.datetime.timestamp(time)*1e9))
+    struct.pack_into("<Q", self.map, 0, sequence+2)
+    try:
+      os.utime(self.path)
+    except OSError:
+      pass
+
+  def read(self):
+    # Returns (sample number, time, {parameter:value}) or None if nothing was published yet. If no consistent
+    # record turns up within READ_TIMEOUT, the sample read last is returned again.
+    deadline=time.monotonic()+self.READ_TIMEOUT
+    delay=0
+    while True:
+      before=self.sequence()
+      if before % 2 == 0:
+        record=self.map[:self.size]
+        if self.sequence() == before:
+          break
+      if time.monotonic() >= deadline:
+        return self.last_sample
+      time.sleep(delay)
+      delay=min(2*delay or 0.0001, self.MAX_RETRY_DELAY)
+    sequence, time_ns, _, _=self.Header.unpack_from(record)
+    if sequence == 0:
+      return None
+    values=self.values.unpack_from(record, self.Header.size)
+    self.last_sample=(sequence//2,
+                      datetime.datetime.fromtimestamp(time_ns/1e9),
+                      dict(zip(self.parameters, values)))
+    return self.last_sample
+
+  def watch(self):
+    # Without inotify, waiting falls back to checking the sequence every POLL_INTERVAL
+    try:
+      self.notifications=inotify_watch(self.path, self.IN_ATTRIB, IN_CLOEXEC | IN_NONBLOCK)
+    except (OSError, AttributeError, TypeError):
+      self.notifications=False
+
+  def wait(self, sample_number, timeout=None):
+    # Blocks until a sample newer than sample_number is published
+    if self.notifications is None:
+      self.watch()
+    deadline=None if timeout is None else time.monotonic()+timeout
+    while self.sequence()//2 <= sample_number:
+      remaining=None if deadline is None else deadline-time.monotonic()
+      if remaining is not None and remaining <= 0:
+        return None
+      if self.notifications:
+        if select.select([self.notifications], [], [], remaining)[0]:
+          try:
+            os.read(self.notifications, 64*ArchiveWatcher.Event.size)
+          except BlockingIOError:
+            pass
+      else:
+        time.sleep(self.POLL_INTERVAL if remaining is None else min(self.POLL_INTERVAL, remaining))
+    return self.read()
+
+  def close(self, release=False):
+    if self.notifications:
+      os.close(self.notifications)
+    self.notifications=None
+    if self.map is None:
+      return
+    if release:
+      sequence, time_ns, count, _=self.Header.unpack_from(self.map)
+      self.Header.pack_into(self.map, 0, sequence, time_ns, count, 0)
+    self.map.close()
+    self.map=None
@@ -1,34 +1,367 @@
 import pandas as pd
 import numpy as np
 
-import datetime, threading, signal, os, tempfile, itertools, random, string, sys, json
+import datetime, threading, signal, os, tempfile, bisect, random, string, sys, json, shutil, copy, contextlib, math
+from time import monotonic
 
 from sensor import Sensor
+from rollups import Rollups
+from livestatus import LiveStatus
+
+def fsync_directory(path):
+  fd=os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+def remove_path(path):
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.unlink(path)
+
+class CommitPolicy:
+  # Decides when appended samples are fsynced, any of the limits being reached triggers a commit
+  def __init__(self, samples=None, seconds=None, bytes=None):
+    self.samples=samples
+    self.seconds=seconds
+    self.bytes=bytes
+    self.reset()
+
+  def reset(self):
+    self.pending_samples=0
+    self.pending_bytes=0
+    self.last_commit=monotonic()
+
+  def record(self, bytes):
+    self.pending_samples+=1
+    self.pending_bytes+=bytes
+
+  def due(self):
+    return ((self.samples is not None and self.pending_samples >= self.samples) or
+            (self.seconds is not None and monotonic()-self.last_commit >= self.seconds) or
+            (self.bytes is not None and self.pending_bytes >= self.bytes))
+
+class ReadWriteLock:
+  # Any number of readers or a single writer. Waiting writers keep new readers out, except for threads which
+  # are reading already or hold the write lock themselves, so that both can nest.
+  def __init__(self):
+    self.condition=threading.Condition()
+    self.readers=0
+    self.writer=None
+    self.write_depth=0
+    self.writers_waiting=0
+    self.local=threading.local()
+
+  def acquire_read(self):
+    depth=getattr(self.local, "depth", 0)
+    with self.condition:
+      if depth == 0 and self.writer != threading.get_ident():
+        self.condition.wait_for(lambda: self.writer is None and self.writers_waiting == 0)
+      self.readers+=1
+    self.local.depth=depth+1
+
+  def release_read(self):
+    self.local.depth-=1
+    with self.condition:
+      self.readers-=1
+      if self.readers == 0:
+        self.condition.notify_all()
+
+  def acquire_write(self):
+    with self.condition:
+      if self.writer == threading.get_ident():
+        self.write_depth+=1
+        return
+      self.writers_waiting+=1
+      self.condition.wait_for(lambda: self.writer is None and self.readers == 0)
+      self.writers_waiting-=1
+      self.writer=threading.get_ident()
+      self.write_depth=1
+
+  def release_write(self):
+    with self.condition:
+      self.write_depth-=1
+      if self.write_depth == 0:
+        self.writer=None
+        self.condition.notify_all()
+
+  @contextlib.contextmanager
+  def reading(self):
+    self.acquire_read()
+    try:
+      yield
+    finally:
+      self.release_read()
+
+  @contextlib.contextmanager
+  def writing(self):
+    self.acquire_write()
+    try:
+      yield
+    finally:
+      self.release_write()
 
 class MeasurementsArchive:
   class ArchiveEntry:
-    column_names=Sensor.Parameters
-
-    def __init__(self, path, start, end, samples, dataframe):
+    # The columns of the archive as configured, see sensor.py. Each entry keeps the columns it was written with,
+    # columns it does not have read as NaN.
+    column_names=Sensor.Columns
+    columns_file="columns.json"
+    log_suffix=".log"
+
+    @staticmethod
+    def record_for(column_names):
+      return np.dtype([("time", "<i8")] + [(name, "<f8") for name in column_names])
+
+    class Buffer:
+      initial_capacity=1024
+
+      def __init__(self, column_names, capacity=initial_capacity):
+        self.column_names=column_names
+        self.length=0
+        self.time=np.empty(capacity, dtype=np.int64)
+        self.columns={name:np.empty(capacity, dtype=np.float64) for name in column_names}
+        self.frame=None
+
+      @classmethod
+      def from_dataframe(cls, column_names, df):
+        buffer=cls(column_names, max(cls.initial_capacity, 2*len(df)))
+        buffer.extend(df.index.values.astype("datetime64[ns]").view(np.int64),
+                      {name:df[name].to_numpy(dtype=np.float64) for name in column_names})
+        return buffer
+
+      def __len__(self):
+        return self.length
+
+      def reserve(self, capacity):
+        if capacity <= len(self.time):
+          return
+        capacity=max(capacity, 2*len(self.time))
+        time=np.empty(capacity, dtype=np.int64)
+        time[:self.length]=self.time[:self.length]
+        self.time=time
+        for name, column in self.columns.items():
+          grown=np.empty(capacity, dtype=np.float64)
+          grown[:self.length]=column[:self.length]
+          self.columns[name]=grown
+
+      def append(self, time, values):
+        self.reserve(self.length+1)
+        self.time[self.length]=time
+        for name, value in zip(self.column_names, values):
+          self.columns[name][self.length]=value
+        self.length+=1
+        self.frame=None
+
+      def extend(self, times, columns):
+        n=len(times)
+        self.reserve(self.length+n)
+        self.time[self.length:self.length+n]=times
+        for name in self.column_names:
+          self.columns[name][self.length:self.length+n]=columns[name]
+        self.length+=n
+        self.frame=None
+
+      def dataframe(self):
+        if self.frame is None:
+          self.frame=pd.DataFrame( {name:self.columns[name][:self.length] for name in self.column_names},
+                                   columns=self.column_names,
+                                   index=pd.DatetimeIndex(self.time[:self.length].view("datetime64[ns]"), name="time"))
+        return self.frame
+
+    def __init__(self, path, start, end, samples, dataframe, column_names=None):
       self.path=path
       self.start=start
       self.end=end
       self.samples=samples
+      self.column_names=list(column_names) if column_names is not None else list(self.column_names)
+      self.log_record=self.record_for(self.column_names)
       self.dataframe=dataframe
+      self.log_file=None
+      self.read_only=False
+      self.stamp=None
+      self.base_stamp=None
+      self.log_offset=None
+
+    @property
+    def dataframe(self):
+      return self.buffer.dataframe() if self.buffer is not None else None
+
+    @dataframe.setter
+    def dataframe(self, df):
+      self.buffer=self.Buffer.from_dataframe(self.column_names, df) if df is not None else None
+
+    @classmethod
+    def read_log(cls, log_path, log_record, offset=0):
+      try:
+        with open(log_path, "rb") as log_file:
+          log_file.seek(offset)
+          data=log_file.read()
+      except FileNotFoundError:
+        return np.empty(0, dtype=log_record)
+      # A trailing partial record is what a crash in the middle of a write leaves behind
+      return np.frombuffer(data, dtype=log_record, count=len(data)//log_record.itemsize)
+
+    @classmethod
+    def unsealed(cls, records, time):
+      # A crash between sealing and removing the log leaves records which are also in the columns
+      return records[records["time"] > time[-1]] if len(time)>0 else records
+
+    @classmethod
+    def is_columnar(cls, path):
+      return os.path.isdir(path)
+
+    @classmethod
+    def column_file(cls, path, name):
+      return os.path.join(path, f"{name}.int64" if name == "time" else f"{name}.float64")
+
+    @classmethod
+    def entry_columns(cls, path):
+      # The columns of an entry in the order of its log records. Columnar entries written before the order
+      # was kept are taken to have the columns of the archive, as far as they have their files.
+      if not cls.is_columnar(path):
+        return list(pd.read_pickle(path).columns)
+      try:
+        with open(os.path.join(path, cls.columns_file)) as columns_file:
+          return json.load(columns_file)
+      except FileNotFoundError:
+        names=[f[:-len(".float64")] for f in os.listdir(path) if f.endswith(".float64")]
+        return [name for name in cls.column_names if name in names] + sorted(name for name in names if name not in cls.column_names)
+
+    @classmethod
+    def map_column(cls, path, name, directory=None):
+      # With the file descriptor of the entry directory given, the column is opened relative to it
+      file=cls.column_file(path, name)
+      dtype=np.int64 if name == "time" else np.float64
+      fd=os.open(os.path.basename(file) if directory is not None else file, os.O_RDONLY, dir_fd=directory)
+      with os.fdopen(fd, "rb") as column_file:
+        if os.fstat(fd).st_size == 0:
+          return np.empty(0, dtype=dtype)
+        return np.memmap(column_file, dtype=dtype, mode="r")
+
+    @classmethod
+    def write_columns(cls, path, time, columns):
+      # The new version is made durable next to the old one before they are swapped, see MeasurementsArchive.recover
+      temporary_path=path + ".tmp"
+      old_path=path + ".old"
+      remove_path(temporary_path)
+      os.mkdir(temporary_path)
+      arrays=[("time", np.asarray(time, dtype=np.int64))] + [(name, np.asarray(values, dtype=np.float64)) for name, values in columns.items()]
+      for name, array in arrays:
+        with open(cls.column_file(temporary_path, name), "wb") as column_file:
+          column_file.write(array.tobytes())
+          column_file.flush()
+          os.fsync(column_file.fileno())
+      with open(os.path.join(temporary_path, cls.columns_file), "w") as columns_file:
+        json.dump(list(columns), columns_file)
+        columns_file.flush()
+        os.fsync(columns_file.fileno())
+      fsync_directory(temporary_path)
+      if os.path.exists(path):
+        os.rename(path, old_path)
+      os.rename(temporary_path, path)
+      fsync_directory(os.path.dirname(path))
+      remove_path(old_path)
+
+    @classmethod
+    def read_columns(cls, path, names=None):
+      # Without names, all columns of the entry. Columns the entry does not have read as NaN.
+      if cls.is_columnar(path):
+        names=names if names is not None else cls.entry_columns(path)
+        # All columns come from the same directory, even if write_columns swaps it meanwhile
+        directory=os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+          time=cls.map_column(path, "time", directory)
+          columns={}
+          for name in names:
+            try:
+              columns[name]=cls.map_column(path, name, directory)
+            except FileNotFoundError:
+              columns[name]=np.full(len(time), np.nan)
+        finally:
+          os.close(directory)
+        if any(len(column) != len(time) for column in columns.values()):
+          raise ValueError("Columnar entry has columns of different lengths")
+      else:
+        df=pd.read_pickle(path)
+        if type(df.index)!=pd.DatetimeIndex:
+          raise ValueError("DataFrame has invalid format")
+        time=df.index.values.astype("datetime64[ns]").view(np.int64)
+        names=names if names is not None else list(df.columns)
+        columns={name:df[name].to_numpy(dtype=np.float64) if name in df.columns else np.full(len(time), np.nan) for name in names}
+      return time, columns
+
+    @classmethod
+    def convert(cls, path):
+      if cls.is_columnar(path):
+        return False
+      time, columns=cls.read_columns(path)
+      cls.write_columns(path, time, columns)
+      return True
+
+    @classmethod
+    def from_file(cls, path, column_names=None):
+      # Stamps are taken before reading, so anything appended meanwhile shows up as a change
+      stamp=cls.stat(path)
+      base_stamp=cls.stat(path, include_log=False)
+      column_names=column_names if column_names is not None else cls.entry_columns(path)
+      time, _=cls.read_columns(path, [])
+      all_records=cls.read_log(path + cls.log_suffix, cls.record_for(column_names))
+      records=cls.unsealed(all_records, time)
+      start=pd.Timestamp(time[0]).to_pydatetime() if len(time)>0 else None
+      end=pd.Timestamp(time[-1]).to_pydatetime() if len(time)>0 else None
+      if len(records)>0:
+        start=start if start is not None else pd.Timestamp(records["time"][0]).to_pydatetime()
+        end=pd.Timestamp(records["time"][-1]).to_pydatetime()
+      entry=cls( path=path,
+                 start=start,
+                 end=end,
+                 samples=len(time)+len(records),
+                 dataframe=None,
+                 column_names=column_names)
+      entry.stamp=stamp
+      entry.base_stamp=base_stamp
+      entry.log_offset=len(all_records)*entry.log_record.itemsize
+      return entry
+
+    @classmethod
+    def stat(cls, path, include_log=True):
+      files=[os.path.join(path, f) for f in os.listdir(path)] if cls.is_columnar(path) else [path]
+      if include_log:
+        files.append(path + cls.log_suffix)
+      mtime, size=0, 0
+      for file in files:
+        try:
+          file_stat=os.stat(file)
+        except FileNotFoundError:
+          continue
+        mtime=max(mtime, file_stat.st_mtime_ns)
+        size+=file_stat.st_size
+      return mtime, size
 
     @classmethod
-    def from_file(cls, path):
-      def check_dataframe(df):
-        return (list(df.columns)==cls.column_names and
-                type(df.index)==pd.DatetimeIndex)
-      df=pd.read_pickle(path)
-      if not check_dataframe(df):
-        raise ValueError("DataFrame has invalid format")
+    def from_manifest(cls, path, record):
       return cls( path=path,
-                  start=df.first_valid_index().to_pydatetime() if len(df)>0 else None,
-                  end=df.last_valid_index().to_pydatetime() if len(df)>0 else None,
-                  samples=df.shape[0],
-                  dataframe=None)
+                  start=datetime.datetime.fromisoformat(record["start"]) if record["start"] else None,
+                  end=datetime.datetime.fromisoformat(record["end"]) if record["end"] else None,
+                  samples=record["samples"],
+                  dataframe=None,
+                  column_names=record.get("columns") or cls.entry_columns(path))
+
+    def manifest_record(self):
+      mtime, size=self.stat(self.path)
+      return {
+        "path":os.path.basename(self.path),
+        "start":self.start.isoformat() if self.start else None,
+        "end":self.end.isoformat() if self.end else None,
+        "samples":self.samples,
+        "mtime":mtime,
+        "size":size,
+        "format":"columnar" if self.is_columnar(self.path) else "pickle",
+        "columns":self.column_names
+      }
 
     @classmethod
     def empty(cls, directory):
@@ -37,9 +370,7 @@ class MeasurementsArchive:
         return path if not os.path.exists(path) else random_file(directory, length)
 
       path=random_file(directory)
-      pd.DataFrame( [], columns=cls.column_names,
-                      dtype=np.float64,
-                      index=pd.DatetimeIndex([], name="time")).to_pickle(path)
+      cls.write_columns(path, [], {name:[] for name in cls.column_names})
       return cls( path=path,
                   start=None,
                   end=None,
@@ -69,50 +400,221 @@ class MeasurementsArchive:
       return other.has_timeframe() and self.overlapping(other.start, other.end)
 
     def is_open(self):
-      return self.dataframe is not None
+      return self.buffer is not None
 
-    def open(self):
-      self.dataframe=pd.read_pickle(self.path)
+    def changed(self):
+      return self.stat(self.path) != self.stamp
+
+    def read_appended(self):
+      # Catches up with samples another process appended to the log, returns False when the entry has to be reloaded instead
+      if self.log_offset is None or self.stat(self.path, include_log=False) != self.base_stamp:
+        return False
+      stamp=self.stat(self.path)
+      records=self.read_log(self.path + self.log_suffix, self.log_record, self.log_offset)
+      if len(records)>0:
+        if self.is_open():
+          self.buffer.extend(records["time"], records)
+        if self.start is None:
+          self.start=pd.Timestamp(records["time"][0]).to_pydatetime()
+        self.end=pd.Timestamp(records["time"][-1]).to_pydatetime()
+        self.samples+=len(records)
+        self.log_offset+=len(records)*self.log_record.itemsize
+      self.stamp=stamp
+      return True
+
+    def read_buffer(self, read_only=False):
+      # All samples of the entry, without opening it, so that several threads can read the same entry
+      time, columns=self.read_columns(self.path, self.column_names)
+      records=self.unsealed(self.read_log(self.path + self.log_suffix, self.log_record), time)
+      samples=len(time)+len(records)
+      # Read only entries will not grow, so there is no point in leaving room for appends
+      capacity=samples if read_only else max(self.Buffer.initial_capacity, 2*samples)
+      buffer=self.Buffer(self.column_names, capacity)
+      buffer.extend(time, columns)
+      buffer.extend(records["time"], records)
+      return buffer
+
+    def open(self, read_only=False):
+      self.buffer=self.read_buffer(read_only)
+      self.read_only=read_only
+
+    @classmethod
+    def slice(cls, time, data, start, end, columns):
+      first=np.searchsorted(time, np.datetime64(start, "ns").astype(np.int64), side="left")
+      last=np.searchsorted(time, np.datetime64(end, "ns").astype(np.int64), side="right")
+      return time[first:last], {name:data[name][first:last] if name in data else np.full(last-first, np.nan) for name in columns}
+
+    def read_span(self, start, end, columns=None):
+      columns=columns if columns is not None else self.column_names
+      if self.is_open():
+        time=self.buffer.time[:len(self.buffer)]
+        data=self.buffer.columns
+      else:
+        time, data=self.read_columns(self.path, columns)
+        records=self.unsealed(self.read_log(self.path + self.log_suffix, self.log_record), time)
+        if len(records)>0:
+          time=np.concatenate([time, records["time"]])
+          data={name:np.concatenate([data[name], records[name] if name in self.column_names else np.full(len(records), np.nan)]) for name in columns}
+      return self.slice(time, data, start, end, columns)
+
+    def open_log(self):
+      log_path=self.path + self.log_suffix
+      self.log_file=open(log_path, "ab")
+      size=self.log_file.tell()
+      if size % self.log_record.itemsize != 0:
+        print(f"{log_path} ends with a partial record, truncating it.")
+        self.log_file.truncate(size - size % self.log_record.itemsize)
 
     def save(self):
       if not self.is_open():
         raise RuntimeError("Cannot save a closed ArchiveEntry")
-      self.dataframe.to_pickle(self.path)
+      if self.read_only:
+        raise RuntimeError("Cannot save a read-only ArchiveEntry")
+      if self.log_file is not None:
+        self.log_file.flush()
+        os.fsync(self.log_file.fileno())
+
+    def seal(self):
+      if not self.is_open():
+        self.open()
+      if self.read_only:
+        raise RuntimeError("Cannot seal a read-only ArchiveEntry")
+      length=len(self.buffer)
+      self.write_columns(self.path, self.buffer.time[:length], {name:column[:length] for name, column in self.buffer.columns.items()})
+      self.close()
+      remove_path(self.path + self.log_suffix)
 
     def close(self):
-      if self.is_open():
-        self.save()
+      if self.log_file is not None:
+        self.log_file.close()
+        self.log_file=None
       self.dataframe=None
+      self.read_only=False
 
     def append_measurement(self, measurement, time):
       if not self.is_open():
         raise RuntimeError("Cannot append to a closed ArchiveEntry")
-      if not self.end is None and self.end > time:
+      if self.read_only:
+        raise RuntimeError("Cannot append to a read-only ArchiveEntry")
+      if not self.end is None and self.end >= time:
         raise RuntimeError(f"Appending measurement with time: {time} which is before end time: {self.end}")
-      frame=pd.DataFrame( [measurement],
-                          columns=MeasurementsArchive.ArchiveEntry.column_names,
-                          index=pd.DatetimeIndex([time], name="time")
-      )
-      self.dataframe=pd.concat([self.dataframe, frame], copy=False, verify_integrity=True)
+      if self.log_file is None:
+        self.open_log()
+      time_ns=np.datetime64(time, "ns").astype(np.int64)
+      record=np.empty(1, dtype=self.log_record)
+      record["time"]=time_ns
+      for name, value in zip(self.column_names, measurement):
+        record[name]=value
+      self.log_file.write(record.tobytes())
+      # Flushed so that readers see it, durability is left to save() and the commit policy
+      self.log_file.flush()
+
+      self.buffer.append(time_ns, measurement)
       self.samples+=1
       self.end=time
       if self.start is None:
         self.start = self.end
 
-  def __init__(self, archive_path):
+  class EntryIndex:
+    # Entries with a timeframe at insertion are kept sorted by start, alongside a running maximum
+    # of their ends, so spans are found with two bisections. Entries inserted without a timeframe
+    # (the one being written to) form a short tail which is checked directly.
+    def __init__(self):
+      self.entries=[]
+      self.starts=[]
+      self.max_ends=[]
+
+    def copy(self):
+      index=MeasurementsArchive.EntryIndex()
+      index.entries=list(self.entries)
+      index.starts=list(self.starts)
+      index.max_ends=list(self.max_ends)
+      return index
+
+    def __len__(self):
+      return len(self.entries)
+
+    def tail(self):
+      return self.entries[len(self.starts):]
+
+    def reindex(self, position):
+      del self.max_ends[position:]
+      for e in self.entries[position:len(self.starts)]:
+        self.max_ends.append(max(self.max_ends[-1], e.end) if self.max_ends else e.end)
+
+    def insert(self, entry):
+      if not entry.has_timeframe():
+        self.entries.append(entry)
+        return []
+      overlapping=self.query(entry.start, entry.end)
+      position=bisect.bisect_right(self.starts, entry.start)
+      self.starts.insert(position, entry.start)
+      self.entries.insert(position, entry)
+      self.reindex(position)
+      return overlapping
+
+    def remove(self, entry):
+      position=next(i for i in range(len(self.entries)-1, -1, -1) if self.entries[i] is entry)
+      del self.entries[position]
+      if position < len(self.starts):
+        del self.starts[position]
+        self.reindex(position)
+
+    def settle(self):
+      # Moves tail entries which gained a timeframe into the sorted part
+      for entry in [e for e in self.tail() if e.has_timeframe()]:
+        self.remove(entry)
+        self.insert(entry)
+
+    def query(self, start, end):
+      first=bisect.bisect_left(self.max_ends, start)
+      last=bisect.bisect_right(self.starts, end)
+      # The end of the newest sorted entry might have grown since it was indexed
+      if last == len(self.starts) and first == last and last > 0:
+        first=last-1
+      return [e for e in self.entries[first:last] + self.tail() if e.overlapping(start, end)]
+
+  manifest_name="manifest.json"
+
+  def __init__(self, archive_path, read_only=False):
     self.archive_path=archive_path
-    self.archive_entries=[]
+    self.read_only=read_only
+    # The index is copied on write: changes are made to a copy which then replaces it, so readers can keep
+    # using the entries they got while the archive is refreshed. The lock keeps them out while it is replaced.
+    self.index=MeasurementsArchive.EntryIndex()
+    self.lock=ReadWriteLock()
+    self.refresh_lock=threading.Lock()
+    self.listing_stamp=None
+    self.rollups=None
+    # Increased whenever refresh() finds new data, consumers compare it to skip redundant work
+    self.data_version=0
+    self.watcher=None
+    self.changes_pending=True
+    # A read-only archive can be open and still empty, until the measurer writes its first entry
+    self.opened=False
+
+  @property
+  def archive_entries(self):
+    return self.index.entries
 
   def last_entry(self):
     return self.archive_entries[-1]
 
   def archive_start(self):
-    return self.archive_entries[0].start
+    return self.archive_entries[0].start if self.archive_entries else None
 
   def archive_end(self):
-    return self.last_entry().end
+    return self.last_entry().end if self.archive_entries else None
+
+  def entry_files(self):
+    # Entries are extensionless pickle files or columnar directories, anything else (logs, manifest) lives next to them
+    return [os.path.join(self.archive_path, f) for f in os.listdir(self.archive_path) if "." not in f]
 
   def open(self):
+    with self.lock.writing():
+      self.open_locked()
+
+  def open_locked(self):
     if self.is_open():
       self.close()
 
@@ -123,97 +625,275 @@ class MeasurementsArchive:
         self.archive_path=tempfile.mkdtemp()
         print(f"Failed to create archive directory: {e}\nWill write to: {self.archive_path}")
 
-    files_in_archive_path=[f for f in
-                          [os.path.join(self.archive_path, f) for f in os.listdir(self.archive_path)]
-                          if os.path.isfile(f)]
-
-    self.append_entries_from_files(files_in_archive_path)
-
+    if not self.read_only:
+      self.recover()
+    self.rollups=Rollups(self.archive_path, MeasurementsArchive.ArchiveEntry.column_names)
+    if not self.read_only:
+      self.rollups.remove_stale()
+    manifest=self.read_manifest()
+    self.listing_stamp=os.stat(self.archive_path).st_mtime_ns
+    index=MeasurementsArchive.EntryIndex()
+    self.append_entries_from_files(self.entry_files(), manifest, index)
+    self.index=index
+    self.opened=True
+    self.data_version+=1
+
+    if self.read_only:
+      return
+    # Measurements are appended in the columns of the archive, an entry with others is left as it is,
+    # only samples still in its log are sealed into it
     if not self.archive_entries:
       self.append_entry()
-
-  def refresh_last_entry(self):
-    self.last_entry().close()
-    last_entry_path=self.last_entry().path
-    self.archive_entries.pop()
-    self.archive_entries.append(MeasurementsArchive.ArchiveEntry.from_file(last_entry_path))
+    elif self.last_entry().column_names != MeasurementsArchive.ArchiveEntry.column_names:
+      self.append_entry(seal=os.path.exists(self.last_entry().path + MeasurementsArchive.ArchiveEntry.log_suffix))
+    elif [e.manifest_record() for e in self.archive_entries] != list(manifest.values()):
+      self.write_manifest()
+
+  def recover(self):
+    # Finishes entry rewrites interrupted by a crash, see ArchiveEntry.write_columns.
+    # An ".old" entry means the new version was already complete, otherwise the old one is still in place.
+    names=os.listdir(self.archive_path)
+    for name in [n for n in names if n.endswith(".old")]:
+      entry_path=os.path.join(self.archive_path, name[:-len(".old")])
+      if not os.path.exists(entry_path):
+        print(f"Completing interrupted rewrite of {entry_path}")
+        os.rename(entry_path + ".tmp", entry_path)
+      remove_path(os.path.join(self.archive_path, name))
+    for name in [n for n in names if n.endswith(".tmp")]:
+      if not os.path.lexists(os.path.join(self.archive_path, name)):
+        continue
+      print(f"Removing incomplete {name}")
+      remove_path(os.path.join(self.archive_path, name))
+
+  def manifest_path(self):
+    return os.path.join(self.archive_path, self.manifest_name)
+
+  def read_manifest(self):
+    try:
+      with open(self.manifest_path()) as manifest_file:
+        return {os.path.join(self.archive_path, r["path"]):r for r in json.load(manifest_file)["entries"]}
+    except FileNotFoundError:
+      return {}
+    except (ValueError, KeyError, TypeError) as e:
+      print(f"Ignoring invalid manifest {self.manifest_path()}: {e}")
+      return {}
+
+  def write_manifest(self):
+    if self.read_only:
+      raise RuntimeError("Cannot write the manifest of a read-only MeasurementsArchive")
+    temporary_path=self.manifest_path() + ".tmp"
+    with open(temporary_path, "w") as manifest_file:
+      json.dump({"columns":MeasurementsArchive.ArchiveEntry.column_names,
+                 "entries":[e.manifest_record() for e in self.archive_entries]}, manifest_file)
+      manifest_file.flush()
+      os.fsync(manifest_file.fileno())
+    os.replace(temporary_path, self.manifest_path())
 
   def refresh(self):
     if not self.is_open():
       raise RuntimeError("Cannot refresh an unopend MeasurementsArchive")
 
-    self.refresh_last_entry()
-
-    already_opened_files=[e.path for e in self.archive_entries]
-    new_files=[f for f in
-              [os.path.join(self.archive_path, f) for f in os.listdir(self.archive_path)]
-              if os.path.isfile(f) and f not in already_opened_files]
-    if new_files:
-      self.append_entries_from_files(new_files)
+    # A single thread refreshes at a time, the others wait for it and find nothing left to do
+    with self.refresh_lock:
+      # With a watcher running nothing has to be checked until it reports a change
+      if self.watcher is not None and not self.changes_pending:
+        return False
+      self.changes_pending=False
+
+      index=self.index.copy()
+      changed=False
+      replaced=False
+      last_entry=index.entries[-1] if index.entries else None
+      if last_entry is not None and last_entry.changed():
+        # Readers might be using the last entry, a refreshed copy takes its place
+        refreshed=copy.copy(last_entry)
+        if not refreshed.read_appended():
+          refreshed=MeasurementsArchive.ArchiveEntry.from_file(last_entry.path, last_entry.column_names)
+        index.remove(last_entry)
+        index.insert(refreshed)
+        replaced=True
+        changed=refreshed.samples != last_entry.samples
+
+      # Entries are only ever added by creating or renaming files, both of which touch the directory
+      listing_stamp=os.stat(self.archive_path).st_mtime_ns
+      if listing_stamp != self.listing_stamp:
+        self.listing_stamp=listing_stamp
+        already_opened_files=set(e.path for e in index.entries)
+        new_files=[f for f in self.entry_files() if f not in already_opened_files]
+        if new_files:
+          self.append_entries_from_files(new_files, self.read_manifest(), index)
+          replaced=changed=True
+
+      if replaced:
+        with self.lock.writing():
+          self.index=index
+          if changed:
+            self.data_version+=1
+      return changed
 
   def is_open(self):
-    return len(self.archive_entries) != 0
+    return self.opened
 
   def close(self):
-    open_entries = (e for e in self.archive_entries if e.is_open())
-    for entry in open_entries:
-      entry.close()
-    self.archive_entries=[]
-
-  def append_entry(self):
+    with self.lock.writing():
+      open_entries = (e for e in self.archive_entries if e.is_open())
+      for entry in open_entries:
+        entry.close()
+      self.index=MeasurementsArchive.EntryIndex()
+      self.opened=False
+      if self.rollups is not None:
+        self.rollups.close()
+
+  def append_entry(self, seal=True):
+    if self.read_only:
+      raise RuntimeError("Cannot append to a read-only MeasurementsArchive")
     try:
-      self.last_entry().close()
+      if seal:
+        self.last_entry().seal()
     except:
       pass
     finally:
-      self.archive_entries.append(MeasurementsArchive.ArchiveEntry.empty(self.archive_path))
-
-  def append_entries_from_files(self, filepaths):
+      index=self.index.copy()
+      index.settle()
+      index.insert(MeasurementsArchive.ArchiveEntry.empty(self.archive_path))
+      with self.lock.writing():
+        self.index=index
+      self.write_manifest()
+
+  def append_entries_from_files(self, filepaths, manifest={}, index=None):
+    index=index if index is not None else self.index
+    entries=[]
     for file in filepaths:
       try:
-        self.archive_entries.append(MeasurementsArchive.ArchiveEntry.from_file(file))
+        record=manifest.get(file)
+        if record is not None and (record["mtime"], record["size"]) == MeasurementsArchive.ArchiveEntry.stat(file):
+          entries.append(MeasurementsArchive.ArchiveEntry.from_manifest(file, record))
+        else:
+          # The columns of an entry never change, even when its samples do
+          entries.append(MeasurementsArchive.ArchiveEntry.from_file(file, record.get("columns") if record is not None else None))
       except:
-        print(f"{file} not a valid pandas DataFrame")
+        print(f"{file} not a valid archive entry")
 
-    self.archive_entries.sort(key=lambda e:e.start if not e.start is None else datetime.datetime.max)
+    entries.sort(key=lambda e:e.start if not e.start is None else datetime.datetime.max)
 
-    for a, b in itertools.combinations(self.archive_entries, 2):
-      if a.overlapping_other(b):
-        print(f"{a.path} and {b.path} are overlapping!") # perhaps a RuntimeError
+    now=datetime.datetime.now()
+    for e in entries:
+      if not e.end is None and e.end > now:
+        print(f"{e.path} is ending in the future.") # perhaps a RuntimeError
+        continue
+      for other in index.insert(e):
+        print(f"{other.path} and {e.path} are overlapping!") # perhaps a RuntimeError
 
-    archive_entries_ending_in_future=(e for e in self.archive_entries if not e.end is None and e.end > datetime.datetime.now())
-    for e in archive_entries_ending_in_future:
-      self.archive_entries.remove(e)
-      print(f"{e.path} is ending in the future.") # perhaps a RuntimeError
+  def convert_to_columnar(self):
+    for entry in self.archive_entries:
+      if not entry.is_open() and MeasurementsArchive.ArchiveEntry.convert(entry.path):
+        print(f"Converted {entry.path} to columnar format")
+    self.write_manifest()
 
   def entries_in_span(self, start, end):
-    entries=[]
-    for e in self.archive_entries:
-      if e.overlapping(start, end):
-        entries.append(e)
-    return entries
+    with self.lock.reading():
+      return self.index.query(start, end)
+
+  def data_stamp(self):
+    # Unlike data_version it is the same in every process looking at the same data
+    if not self.archive_entries:
+      return (0, None, 0)
+    last_entry=self.last_entry()
+    return (len(self.archive_entries), os.path.basename(last_entry.path), last_entry.samples)
+
+  def samples_in_span(self, start, end):
+    # An estimate, samples are assumed to be spread evenly over each entry
+    samples=0
+    for e in self.entries_in_span(start, end):
+      duration=(e.end-e.start).total_seconds()
+      overlap=(min(e.end, end)-max(e.start, start)).total_seconds()
+      samples+=e.samples*overlap/duration if duration>0 else e.samples
+    return samples
+
+  def resolution_for(self, start, end, max_points):
+    if self.samples_in_span(start, end) <= max_points:
+      return None
+    return self.rollups.tier_for(start, end, max_points)
+
+  def rollup_in_span(self, resolution, start, end, columns=None):
+    with self.lock.reading():
+      return self.rollups.read_span(resolution, start, end, self, columns)
+
+  def query(self, start, end, columns=None, resolution=None, read_span=None, as_arrays=False):
+    # Samples in the span, or buckets of the rollup at resolution, of the given columns only. Returned as a
+    # DataFrame indexed by time or as (time in ns, {column:values}). Entries are read with
+    # read_span(entry, start, end, columns) if given, so that callers can put a cache in between.
+    with self.lock.reading():
+      return self.query_locked(start, end, columns, resolution, read_span, as_arrays)
+
+  def query_locked(self, start, end, columns, resolution, read_span, as_arrays):
+    columns=list(columns) if columns is not None else list(self.ArchiveEntry.column_names)
+    if resolution is not None:
+      # Statistics like <column>_min come with their column
+      dataframe=self.rollup_in_span(resolution, start, end, self.rollups.columns_of(columns))[columns]
+      if as_arrays:
+        return dataframe.index.values.view(np.int64), {column:dataframe[column].to_numpy() for column in columns}
+      return dataframe
+
+    if read_span is None:
+      read_span=lambda entry, start, end, columns: entry.read_span(start, end, columns)
+    spans=[read_span(entry, start, end, columns) for entry in self.entries_in_span(start, end)]
+
+    # Copied once into arrays of the final size, only the rows in the span are touched
+    length=sum(len(time) for time, _ in spans)
+    time=np.empty(length, dtype=np.int64)
+    data={column:np.empty(length, dtype=np.float64) for column in columns}
+    position=0
+    for span_time, span_data in spans:
+      time[position:position+len(span_time)]=span_time
+      for column in columns:
+        data[column][position:position+len(span_time)]=span_data[column]
+      position+=len(span_time)
+
+    if as_arrays:
+      return time, data
+    return pd.DataFrame(data, index=pd.DatetimeIndex(time.view("datetime64[ns]"), name="time"), copy=False)
 
 class Measurer(threading.Thread):
-  def __init__(self, archive_path, period=60, max_samples_per_file=1000000, save_every_samples=5):
-    self.sensor = Sensor()
+  def __init__(self, archive_path, period=60, max_samples_per_file=1000000, save_every_samples=5, commit_policy=None):
+    # Each sensor is read at its own period if it has one, samples are taken at the shortest one. The archive
+    # gets a row for every sample, or with aggregation a row of statistics of the samples in each period.
+    self.sensor = Sensor(period)
 
     self.archive_path=archive_path
     self.archive=MeasurementsArchive(archive_path)
 
-    self.period=period
+    self.sample_period=self.sensor.period
+    self.aggregate=Sensor.Aggregate(len(Sensor.Parameters)) if Sensor.Aggregated else None
+    # The live status shows the last reading of every sensor, rows of the archive have NaN where there was none
+    self.status=np.full(len(Sensor.Parameters), np.nan)
+    self.period=period if self.aggregate is not None else self.sample_period
 
     self.max_samples_per_file=max_samples_per_file
-    self.save_every_samples=save_every_samples
-    self.appends_since_store=0
+    self.commit_policy=commit_policy or CommitPolicy(samples=save_every_samples)
 
     self.stop_event=threading.Event()
     threading.Thread.__init__(self)
 
   def make_measurement(self):
     time = datetime.datetime.now()
-    measurement = self.sensor.measure()
+    measurement = self.sensor.measure(timeout=self.sample_period/2)
+    if self.aggregate is not None:
+      self.aggregate.add(measurement)
+      return
+    self.write_measurement(measurement, time)
+
+  def write_aggregate(self):
+    # Stamped at the end of the period it covers
+    measurement = self.aggregate.measurement()
+    self.aggregate.reset()
+    self.write_measurement(measurement, datetime.datetime.now())
+
+  def write_measurement(self, measurement, time):
+    if all(math.isnan(value) for value in measurement):
+      return
     self.append_to_archive(measurement, time)
-    self.write_status(measurement, time)
+    self.write_status(measurement[:len(Sensor.Parameters)], time)
 
   def append_to_archive(self, measurement, time):
     try:
@@ -225,49 +905,82 @@ class Measurer(threading.Thread):
       last_entry.open()
 
     last_entry.append_measurement(measurement, time)
+    self.archive.rollups.append(measurement, time)
 
-    self.appends_since_store+=1
-    if self.appends_since_store > self.save_every_samples:
+    self.commit_policy.record(last_entry.log_record.itemsize)
+    if self.commit_policy.due():
       last_entry.save()
-      self.appends_since_store=0
+      self.archive.rollups.sync()
+      self.archive.write_manifest()
+      self.commit_policy.reset()
 
     if last_entry.samples > self.max_samples_per_file:
       self.archive.append_entry()
 
+  def row_of(self, sample):
+    # The archive period a sample falls into, rounding keeps samples on period boundaries in the later one
+    return int(sample*self.sample_period/self.period + 1e-9)
+
   def write_status(self, measurement, time):
-    json_dict = {"time":time.isoformat()}
-    for index, parameter_name in enumerate(Sensor.Parameters):
-      json_dict[parameter_name] = measurement[index]
-    with open(self.status_file_path, "w") as status_file:
-      json.dump(json_dict, status_file)
-      status_file.close()
+    measurement=np.asarray(measurement, dtype=np.float64)
+    self.status=np.where(np.isnan(measurement), self.status, measurement)
+    self.live_status.publish(self.status, time)
 
   def stop(self):
     self.stop_event.set()
     self.archive.close()
-    os.unlink(self.status_file_path)
 
   def run(self):
     self.archive.open()
-    self.status_file_path = os.path.join(self.archive_path, "status.json")
-    if os.path.exists(self.status_file_path):
-      print(f"{self.status_file_path} exists! This might mean there are two instances running or previous instance exited unexpectedly.")
-
+    self.archive.rollups.catch_up(self.archive)
+    self.live_status=LiveStatus(LiveStatus.path_for(self.archive.archive_path), Sensor.Parameters)
+    self.live_status.create()
+
+    # Samples are due at fixed deadlines on the monotonic clock, so the time taken by a reading does not
+    # delay the following ones. Deadlines which have already passed by a whole period are skipped.
+    start=monotonic()
+    sample=0
     while True:
       self.make_measurement()
-      if self.stop_event.wait(timeout = self.period):
+      following=max(sample+1, int((monotonic()-start)/self.sample_period))
+      if following > sample+1:
+        print(f"Measuring took too long, skipping {following-sample-1} samples.")
+      if self.aggregate is not None and self.row_of(following) != self.row_of(sample):
+        self.write_aggregate()
+      sample=following
+      if self.stop_event.wait(timeout = max(0, start+sample*self.sample_period-monotonic())):
         break
+    self.sensor.close()
+    self.live_status.close(release=True)
 
 if __name__ == "__main__":
   PERIOD=30
-  SAVE_EVERY=2
-  SAMPLES_IN_HOUR=3600/PERIOD
-  SAMPLES_IN_DAY=24*SAMPLES_IN_HOUR
-  MAX_SAMPLES=7*SAMPLES_IN_DAY
+  # Seconds of measurements between commits and in each archive entry
+  SAVE_EVERY=2*PERIOD
+  ENTRY_SPAN=7*24*3600
 
   archive_path = os.environ.get("MEASUREMENTS_PATH")
 
-  measurer=Measurer(archive_path, PERIOD, max_samples_per_file=MAX_SAMPLES, save_every_samples=SAVE_EVERY)
+  if sys.argv[1:] == ["--convert"]:
+    archive=MeasurementsArchive(archive_path)
+    archive.open()
+    archive.convert_to_columnar()
+    sys.exit(0)
+
+  # Samples appended since the last commit are lost on power failure, fewer commits mean fewer flash writes
+  def optional_number(name):
+    value=os.environ.get(name)
+    return float(value) if value else None
+  commit_policy=CommitPolicy(samples=optional_number("COMMIT_EVERY_SAMPLES"),
+                             seconds=optional_number("COMMIT_EVERY_SECONDS"),
+                             bytes=optional_number("COMMIT_EVERY_BYTES"))
+  default_commits=commit_policy.samples is None and commit_policy.seconds is None and commit_policy.bytes is None
+
+  measurer=Measurer(archive_path, PERIOD, commit_policy=commit_policy)
+  # Rows are written at the shortest period of the sensors unless they are aggregated
+  measurer.max_samples_per_file=int(ENTRY_SPAN/measurer.period)
+  if default_commits:
+    commit_policy.samples=max(1, round(SAVE_EVERY/measurer.period))
 
   def catch_signal(*args):
     measurer.stop()
@@ -1,57 +1,287 @@
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 
+import base64, collections, datetime, hashlib, json, os, threading
+
+# Also used by plotly, and so by Dash, to encode responses
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
 from sensor import Sensor
+from downsample import downsample, lttb, minmax
 
 #TODO: remove
 import time
 
+def typed_array(values):
+  # Plotly's base64 encoding of typed arrays, a fraction of the size of the numbers written out.
+  # Recent versions of plotly encode arrays like this themselves.
+  if isinstance(values, dict):
+    return values
+  values = np.ascontiguousarray(values, dtype="<f8")
+  return {"dtype":"f8", "bdata":base64.b64encode(values.tobytes()).decode("ascii")}
+
+def epoch_ms(times):
+  # Times are sent as milliseconds since the epoch, which a date axis takes as they are
+  return np.asarray(times).astype("datetime64[ns]").astype(np.int64)/1e6
+
+def json_default(value):
+  if isinstance(value, np.ndarray):
+    return value.tolist()
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, (datetime.datetime, datetime.date)):
+    return value.isoformat()
+  raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+def dumps(value):
+  if orjson is not None:
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+  return json.dumps(value, default=json_default, separators=(",", ":"))
+
+def loads(value):
+  return orjson.loads(value) if orjson is not None else json.loads(value)
+
+class EntryCache:
+  # Decoded archive entries, least recently used ones are evicted once max_bytes is exceeded.
+  # Entries are keyed by path and dropped when the stat stamp of their files changes.
+  def __init__(self, max_bytes=64*1024*1024):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def evict(self, path):
+    _, _, size = self.entries.pop(path)
+    self.bytes -= size
+
+  def buffer(self, entry):
+    stamp = entry.stat(entry.path)
+    with self.lock:
+      cached = self.entries.get(entry.path)
+      if cached is not None and cached[0] == stamp:
+        self.entries.move_to_end(entry.path)
+        return cached[1]
+
+    # Read without holding the lock, two threads missing the same entry at once both read it
+    buffer = entry.read_buffer(read_only=True)
+
+    size = buffer.time.nbytes + sum(column.nbytes for column in buffer.columns.values())
+    with self.lock:
+      if entry.path in self.entries:
+        self.evict(entry.path)
+      self.entries[entry.path] = (stamp, buffer, size)
+      self.bytes += size
+      while self.bytes > self.max_bytes and len(self.entries) > 1:
+        self.evict(next(iter(self.entries)))
+    return buffer
+
+  def read_span(self, entry, start, end, columns=None):
+    columns = columns if columns is not None else entry.column_names
+    buffer = self.buffer(entry)
+    return entry.slice(buffer.time[:len(buffer)], buffer.columns, start, end, columns)
+
+class SharedFigureCache:
+  # Serialized figures in files, shared by every process plotting the same archive. Files are replaced
+  # atomically, the least recently written ones are removed once max_bytes is exceeded.
+  def __init__(self, directory, max_bytes=32*1024*1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+
+  @classmethod
+  def path_for(cls, archive_path):
+    name = hashlib.sha1(os.path.abspath(archive_path).encode()).hexdigest()[:12]
+    if os.path.isdir("/dev/shm"):
+      return os.path.join("/dev/shm", f"environment-monitor-figures-{name}")
+    return os.path.join(archive_path, "figures.cache")
+
+  def path(self, key):
+    return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+  def get(self, key):
+    try:
+      with open(self.path(key)) as figure_file:
+        return figure_file.read()
+    except FileNotFoundError:
+      return None
+
+  def put(self, key, figure):
+    path = self.path(key)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as figure_file:
+      figure_file.write(figure)
+    os.replace(temporary_path, path)
+    self.evict()
+
+  def evict(self):
+    files = []
+    for name in os.listdir(self.directory):
+      # Files other processes are still writing are left alone
+      if name.endswith(".tmp"):
+        continue
+      try:
+        files.append((os.stat(os.path.join(self.directory, name)), name))
+      except FileNotFoundError:
+        pass
+    size = sum(file_stat.st_size for file_stat, _ in files)
+    for file_stat, name in sorted(files, key=lambda file: file[0].st_mtime_ns):
+      if size <= self.max_bytes:
+        break
+      try:
+        os.unlink(os.path.join(self.directory, name))
+      except FileNotFoundError:
+        pass
+      size -= file_stat.st_size
+
+class FigureCache:
+  # Figures as they are returned to Dash, least recently used ones are evicted once the size of their JSON
+  # exceeds max_bytes. Figures missing here are looked up in the shared cache, if there is one, which holds
+  # them as JSON and so is only parsed once per process.
+  def __init__(self, max_bytes=16*1024*1024, shared=None):
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.figures = collections.OrderedDict()
+    self.shared = shared
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    with self.lock:
+      cached = self.figures.get(key)
+      if cached is not None:
+        self.figures.move_to_end(key)
+        return cached[0]
+    if self.shared is None:
+      return None
+    serialized = self.shared.get(key)
+    if serialized is None:
+      return None
+    figure = loads(serialized)
+    self.put(key, figure, serialized, share=False)
+    return figure
+
+  def put(self, key, figure, serialized=None, share=True):
+    serialized = serialized if serialized is not None else dumps(figure)
+    with self.lock:
+      if key in self.figures:
+        self.bytes -= self.figures.pop(key)[1]
+      self.figures[key] = (figure, len(serialized))
+      self.bytes += len(serialized)
+      while self.bytes > self.max_bytes and len(self.figures) > 1:
+        self.bytes -= self.figures.popitem(last=False)[1][1]
+    if share and self.shared is not None:
+      self.shared.put(key, serialized)
+
 class Plotter:
-  def __init__(self, archive):
+  # Data is loaded at up to this many times the point budget, so that downsampling has peaks to pick from
+  OVERSAMPLING = 16
+  # Spans are widened to whole steps, so that requests for "the last 12 hours" made a few seconds apart are the same
+  SPAN_STEP = datetime.timedelta(minutes=1)
+  WINDOW_STEP = datetime.timedelta(seconds=1)
+
+  def __init__(self, archive, max_points=2000, cache_bytes=64*1024*1024, figure_cache_bytes=16*1024*1024, shared_figures=None):
     self.archive = archive
-    self.previous_result = {"arguments":None, "plot":None}
+    self.max_points = max_points
+    self.cache = EntryCache(cache_bytes)
+    self.figures = FigureCache(figure_cache_bytes, shared_figures)
+    self.layouts = {}
+    self.traces = {}
+
+  def resolution_for(self, start, end, max_points):
+    return self.archive.resolution_for(start, end, max_points*self.OVERSAMPLING)
+
+  def read_entry_span(self, entry, start, end, columns):
+    # The entry being written to changes with every sample, caching it would only churn the cache
+    if entry is self.archive.last_entry():
+      return entry.read_span(start, end, columns)
+    return self.cache.read_span(entry, start, end, columns)
+
+  def dataframe_in_span(self, start, end, resolution=None, columns=None):
+    return self.archive.query(start, end, columns, resolution, self.read_entry_span)
+
+  def envelope_columns(self, parameter):
+    # With aggregated samples the archive has <parameter>_min and _max columns itself, their extremes are the true ones
+    low, high = f"{parameter}_min", f"{parameter}_max"
+    if low in self.archive.ArchiveEntry.column_names:
+      return f"{low}_min", f"{high}_max"
+    return low, high
+
+  def plotted_columns(self, parameters, resolution):
+    # Rollup buckets are drawn as the envelope of their extremes, so that short peaks and dips stay visible
+    if resolution is None:
+      return list(parameters)
+    return list(parameters) + [column for parameter in parameters for column in self.envelope_columns(parameter) + (f"{parameter}_count",)]
+
+  def plotted_dataframe(self, start, end, resolution, parameters):
+    return self.dataframe_in_span(start, end, resolution, self.plotted_columns(parameters, resolution))
 
-  def dataframe_in_span(self, start, end):
-    entries=self.archive.entries_in_span(start, end)
-    combined_df=pd.DataFrame()
+  def samples_in(self, dataframe, parameters):
+    # Rollup buckets know how many samples they hold
+    counts = [f"{parameter}_count" for parameter in parameters if f"{parameter}_count" in dataframe]
+    return int(dataframe[counts].sum().max()) if counts else len(dataframe)
 
-    for e in entries:
-      was_open = e.is_open()
-      if not was_open: e.open()
-      combined_df=pd.concat([combined_df, e.dataframe[start : end]])
-      if not was_open: e.close()
+  def series(self, dataframe, parameter):
+    # The values of a parameter with the downsampling method which suits them
+    low, high = self.envelope_columns(parameter)
+    if low not in dataframe:
+      return dataframe.index.values, dataframe[parameter].to_numpy(), lttb
+    x = np.repeat(dataframe.index.values, 2)
+    y = np.column_stack([dataframe[low].to_numpy(dtype=np.float64), dataframe[high].to_numpy(dtype=np.float64)]).ravel()
+    return x, y, minmax
 
-    return combined_df
+  def value_range(self, dataframe, parameter):
+    low, high = self.envelope_columns(parameter)
+    if low not in dataframe:
+      low = high = parameter
+    return float(dataframe[low].min()), float(dataframe[high].max())
 
-  def generate_plot(self, dataframe, parameters):
-    Y_AXIS_TICKS=5
-    SUBPLOTS_DOMAIN_GAP=0.02
-    PLOT_GRID_COLOR="#ccc"
+  def trace_points(self, dataframe, parameter, max_points, detail=None):
+    x, y, method = self.series(dataframe, parameter)
+    x, y = downsample(x, y, max_points, method)
+    if detail is None:
+      return x, y
+    # The visible window comes from its own, finer data, the overview only fills in around it
+    window_start, window_end, detail_dataframe, _ = detail
+    dx, dy, method = self.series(detail_dataframe, parameter)
+    dx, dy = downsample(dx, dy, max_points, method)
+    before = x < np.datetime64(window_start, "ns")
+    after = x > np.datetime64(window_end, "ns")
+    return np.concatenate([x[before], dx, x[after]]), np.concatenate([y[before], dy, y[after]])
 
+  Y_AXIS_TICKS = 5
+  SUBPLOTS_DOMAIN_GAP = 0.02
+  PLOT_GRID_COLOR = "#ccc"
+
+  def empty_layout(self):
+    fig = go.Figure()
+    fig.add_shape(
+      type="rect",
+      xref="paper", yref="paper",
+      x0=-0.5, y0=-0.5,
+      x1=1.5, y1=1.5,
+      fillcolor="White",
+    )
+    fig.add_annotation(
+      text="No data in selected range.",
+      font=dict(size=24),
+      align="center",
+      xref="paper", yref="paper",
+      x=0.5, y=0.5, showarrow=False
+    )
+    return fig.to_plotly_json()["layout"]
+
+  def build_layout(self, parameters):
     fig = go.Figure()
-    if len(parameters)==0 or dataframe.empty:
-      fig.add_shape(
-        type="rect",
-        xref="paper", yref="paper",
-        x0=-0.5, y0=-0.5,
-        x1=1.5, y1=1.5,
-        fillcolor="White",
-      )
-      fig.add_annotation(
-        text="No data in selected range.",
-        font=dict(size=24),
-        align="center",
-        xref="paper", yref="paper",
-        x=0.5, y=0.5, showarrow=False
-      )
-      return fig
 
     # Set general plot layout
     fig.update_layout(
       showlegend=False,
       autosize=True,
       plot_bgcolor="#fff",
-      hovermode="x"
+      hovermode="x",
     )
 
     # Set X axis layout
@@ -62,14 +292,15 @@ class Plotter:
             size=12
           )
         ),
+        type="date",
         side="top",
         showgrid=True,
         showspikes=True,
         spikemode="across",
         spikethickness=2,
-        gridcolor=PLOT_GRID_COLOR,
+        gridcolor=self.PLOT_GRID_COLOR,
         ticks="outside",
-        tickcolor=PLOT_GRID_COLOR,
+        tickcolor=self.PLOT_GRID_COLOR,
         tickwidth=1,
         ticklen=10,
         mirror="ticks",
@@ -81,32 +312,9 @@ class Plotter:
       ),
     )
 
-    n_subplots=((len(parameters) + 1) // 2)
-    n_gaps=n_subplots-1
-    subplot_height=(1.0-n_gaps*SUBPLOTS_DOMAIN_GAP)/n_subplots
-
     for i in range(len(parameters)):
       parameter=parameters[i]
 
-      # Add trace
-      fig.add_trace(go.Scatter(
-        x=dataframe.index,
-        y=dataframe[parameter],
-        yaxis=f"y{i+1}",
-        name=Sensor.Decorations[parameter]["name"],
-        line=dict(
-          color=Sensor.Decorations[parameter]["color"]
-        )
-      ))
-
-      # Y axis calculated properties
-      y_axis_min=dataframe[parameter].min()
-      y_axis_step=(dataframe[parameter].max()-y_axis_min)/(Y_AXIS_TICKS-1)
-      y_axis_side="left" if i%2==0 else "right"
-      y_axis_overlaying="free" if i%2==0 else f"y{i}" if i!=0 else "y"
-      y_axis_domain_upper=round(1-i//2*(subplot_height+SUBPLOTS_DOMAIN_GAP),3)
-      y_axis_domain_lower=round(y_axis_domain_upper-subplot_height,3)
-
       # Set Y axis layout
       yaxis_layout=dict(
         title=dict(
@@ -121,47 +329,200 @@ class Plotter:
         ),
 
         color=Sensor.Decorations[parameter]["color"],
-        gridcolor=PLOT_GRID_COLOR,
+        gridcolor=self.PLOT_GRID_COLOR,
         showgrid=True,
         showspikes=True,
         spikemode="toaxis",
         spikethickness=2,
         fixedrange=True,
 
-        tick0=y_axis_min,
-        dtick=y_axis_step,
         tickformat=Sensor.Decorations[parameter]["format"],
         ticksuffix=Sensor.Decorations[parameter]["suffix"],
 
-        side=y_axis_side,
-        overlaying=y_axis_overlaying,
-        domain=[y_axis_domain_lower, y_axis_domain_upper],
         automargin=True,
         anchor="x",
+        **self.axis_position(i, len(parameters))
       )
 
       # Apply layout
       fig.update_layout(**{f"yaxis{i+1}":yaxis_layout})
 
-    return fig
+    return fig.to_plotly_json()["layout"]
+
+  def axis_position(self, index, count):
+    # Parameters are plotted in pairs, one on each side of a subplot
+    n_subplots=((count + 1) // 2)
+    n_gaps=n_subplots-1
+    subplot_height=(1.0-n_gaps*self.SUBPLOTS_DOMAIN_GAP)/n_subplots
+    y_axis_domain_upper=round(1-index//2*(subplot_height+self.SUBPLOTS_DOMAIN_GAP),3)
+    y_axis_domain_lower=round(y_axis_domain_upper-subplot_height,3)
+    return dict(
+      side="left" if index%2==0 else "right",
+      # Plotly calls the first y axis just y
+      overlaying="free" if index%2==0 else f"y{index}" if index!=1 else "y",
+      domain=[y_axis_domain_lower, y_axis_domain_upper]
+    )
 
-  def get_plot(self, start, end, parameters):
+  def layout_for(self, parameters):
+    # Layouts only depend on the parameters, they are validated by plotly once and then reused as plain dicts
+    key = tuple(parameters)
+    if key not in self.layouts:
+      self.layouts[key] = self.build_layout(parameters) if len(parameters) > 0 else self.empty_layout()
+    return self.layouts[key]
+
+  def trace_for(self, parameter, index):
+    key = (parameter, index)
+    if key not in self.traces:
+      self.traces[key] = go.Scatter(
+        yaxis=f"y{index+1}",
+        name=Sensor.Decorations[parameter]["name"],
+        line=dict(
+          color=Sensor.Decorations[parameter]["color"]
+        )
+      ).to_plotly_json()
+    return self.traces[key]
+
+  def generate_plot(self, dataframe, parameters, max_points=None, resolution=None, detail=None):
+    if len(parameters)==0 or dataframe.empty:
+      return {"data":[], "layout":self.layout_for([])}
+
+    # Only what depends on the data is set on a copy of the cached layout
+    layout = dict(self.layout_for(parameters))
+    layout["meta"] = dict(
+      resolution=resolution or "raw",
+      samples=self.samples_in(dataframe, parameters),
+      points={}
+    )
+    if detail is not None:
+      layout["xaxis"] = dict(layout["xaxis"], range=[detail[0].isoformat(), detail[1].isoformat()])
+      layout["meta"]["detail"] = dict(resolution=detail[3] or "raw", samples=self.samples_in(detail[2], parameters))
+
+    data = []
+    for i in range(len(parameters)):
+      parameter=parameters[i]
+
+      x, y = self.trace_points(dataframe, parameter, max_points or self.max_points, detail)
+      layout["meta"]["points"][parameter] = len(x)
+      data.append(dict(self.trace_for(parameter, i), x=typed_array(epoch_ms(x)), y=typed_array(y)))
+
+      y_axis_min, y_axis_max = self.value_range(dataframe, parameter)
+      y_axis_step=(y_axis_max-y_axis_min)/(self.Y_AXIS_TICKS-1)
+      # Plotly calls the first y axis just yaxis
+      y_axis = f"yaxis{i+1}" if i != 0 else "yaxis"
+      layout[y_axis] = dict(layout[y_axis], tick0=y_axis_min, dtick=y_axis_step)
+
+    return {"data":data, "layout":layout}
+
+  @staticmethod
+  def parse_time(value):
+    return pd.Timestamp(value).to_pydatetime()
+
+  @staticmethod
+  def normalize_span(start, end, step):
+    start = datetime.datetime.min + (start - datetime.datetime.min)//step*step
+    end = datetime.datetime.min - (datetime.datetime.min - end)//step*step
+    return start, end
+
+  def get_plot(self, start, end, parameters, max_points=None, window=None):
     print(f"There are {len(self.archive.archive_entries)} entries in the archive.")
     function_start = time.time()
 
-    dataframe = self.dataframe_in_span(start, end)
+    start, end = self.normalize_span(start, end, self.SPAN_STEP)
+    if window is not None:
+      window = self.normalize_span(window[0], window[1], self.WINDOW_STEP)
+    # Only a window inside the plotted span needs its own data
+    if window is not None and not (start <= window[0] < window[1] <= end and window != (start, end)):
+      window = None
 
-    arguments_dict = {
-      "start":dataframe.first_valid_index(),
-      "end":dataframe.last_valid_index(),
-      "parameters":parameters
-    }
+    # Nothing new was written since the same request, no need to even load the data
+    max_points = max_points or self.max_points
+    key = (start, end, tuple(parameters), max_points, window, self.archive.data_stamp())
+    plot = self.figures.get(key)
+    cached = plot is not None
 
-    cached = True
-    if self.previous_result["arguments"] != arguments_dict:
-      self.previous_result = {"arguments":arguments_dict, "plot":self.generate_plot(dataframe, parameters)}
-      cached = False
+    if not cached:
+      resolution = self.resolution_for(start, end, max_points)
+      dataframe = self.plotted_dataframe(start, end, resolution, parameters)
+      detail = None
+      if window is not None:
+        detail_resolution = self.resolution_for(window[0], window[1], max_points)
+        detail = (window[0], window[1], self.plotted_dataframe(window[0], window[1], detail_resolution, parameters), detail_resolution)
+      plot = self.generate_plot(dataframe, parameters, max_points, resolution, detail)
+      self.figures.put(key, plot)
 
     print(f"get_plot took:{(time.time()-function_start):.2f}s. The plot was: {'recalled' if cached else 'redrawn'}")
 
-    return self.previous_result["plot"]
+    return plot
+
+  def live_data(self, start, end, parameters, max_points=None):
+    # The data of the longest preset together with the parts of the figure of every selection of parameters,
+    # so that assets/live.js can draw any preset and selection without the server. Returns it with the state
+    # live_update needs to send what is measured later.
+    max_points = max_points or self.max_points
+    resolution = self.resolution_for(start, end, max_points)
+    dataframe = self.plotted_dataframe(start, end, resolution, parameters)
+    x, y = {}, {}
+    for parameter in parameters:
+      if dataframe.empty:
+        trace_x, trace_y = np.empty(0, dtype="datetime64[ns]"), np.empty(0)
+      else:
+        trace_x, trace_y = self.trace_points(dataframe, parameter, max_points)
+      x[parameter] = typed_array(epoch_ms(trace_x))
+      y[parameter] = typed_array(trace_y)
+
+    # The layout of a selection is put together from the y axis and trace of each parameter and the position
+    # of its axis, validated by plotly as parts of the layout of all parameters
+    layout = dict(self.layout_for(parameters))
+    layout.pop("template", None)
+    axes, traces = {}, {}
+    for i, parameter in enumerate(parameters):
+      # Plotly calls the first y axis just yaxis
+      axis = layout.pop(f"yaxis{i+1}" if i != 0 else "yaxis")
+      axes[parameter] = {key:value for key, value in axis.items() if key not in ("side", "overlaying", "domain")}
+      traces[parameter] = {key:value for key, value in self.trace_for(parameter, 0).items() if key != "yaxis"}
+    empty_layout = dict(self.layout_for([]))
+    empty_layout.pop("template", None)
+
+    data = {
+      "end":float(epoch_ms(end)),
+      "parameters":list(parameters),
+      "resolution":resolution or "raw",
+      "x":x,
+      "y":y,
+      "layout":layout,
+      "axes":axes,
+      # The positions of the axes of a selection of n parameters are at n-1
+      "positions":[[self.axis_position(i, count) for i in range(count)] for count in range(1, len(parameters)+1)],
+      "traces":traces,
+      "empty_layout":empty_layout,
+      "template":self.layout_for([]).get("template"),
+      "y_axis_ticks":self.Y_AXIS_TICKS
+    }
+    state = {
+      "parameters":list(parameters),
+      "last":(dataframe.index[-1] if not dataframe.empty else start).isoformat(),
+      "resolution":resolution or "raw",
+      "max_points":max_points
+    }
+    return data, state
+
+  def live_update(self, state, start, end):
+    # What was measured since live_data or the previous live_update, as lists per parameter. Returns None if
+    # live_data has to be loaded again, otherwise the update (None if nothing is new) and the state after it.
+    if state.get("resolution") != "raw" or self.resolution_for(start, end, state["max_points"]) is not None:
+      return None
+
+    last = self.parse_time(state["last"])
+    new = self.dataframe_in_span(last, end, columns=state["parameters"])
+    if not new.empty:
+      new = new[new.index.values > np.datetime64(last, "ns")]
+    if new.empty:
+      return None, state
+
+    update = {"end":float(epoch_ms(end)), "x":{}, "y":{}}
+    for parameter in state["parameters"]:
+      values = new[parameter].to_numpy(dtype=np.float64)
+      finite = np.isfinite(values)
+      update["x"][parameter] = epoch_ms(new.index.values[finite]).tolist()
+      update["y"][parameter] = values[finite].tolist()
+    return update, dict(state, last=new.index[-1].isoformat())
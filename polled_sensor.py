@@ -0,0 +1,40 @@
+import asyncio, time
+
+class PolledSensor:
+  # Sensors which measure on their own and tell when a result is ready. start() sets them measuring and
+  # returns straight away, poll() returns a new sample or None without waiting and read() awaits one.
+  # Backends implement start(), data_ready() and fetch().
+  POLL_INTERVAL = 0.1
+
+  started = False
+
+  def start(self):
+    raise NotImplementedError
+
+  def data_ready(self):
+    raise NotImplementedError
+
+  def fetch(self):
+    raise NotImplementedError
+
+  def ensure_started(self):
+    if not self.started:
+      self.start()
+      self.started = True
+
+  def poll(self):
+    self.ensure_started()
+    if not self.data_ready():
+      return None
+    return self.fetch()
+
+  async def read(self):
+    while (sample := self.poll()) is None:
+      await asyncio.sleep(self.POLL_INTERVAL)
+    return sample
+
+  def measure(self):
+    # Blocking, for scripts reading a single sensor
+    while (sample := self.poll()) is None:
+      time.sleep(self.POLL_INTERVAL)
+    return sample
@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy as np
+
+import datetime, hashlib, json, os
+
+class RollupTier:
+  # Buckets of a fixed width, each holding min, max, sum and count of every column.
+  # Completed buckets are appended to an append-only file, the current one is kept in memory. The file is
+  # named after the columns it holds, with other columns the tier starts over in a new file.
+  def __init__(self, directory, name, width, column_names):
+    self.path=os.path.join(directory, f"rollup.{name}.{self.digest(column_names)}")
+    self.name=name
+    self.width=width
+    self.column_names=column_names
+    fields=[("time", "<i8")]
+    for column in column_names:
+      fields+=[(f"{column}_min", "<f8"), (f"{column}_max", "<f8"), (f"{column}_sum", "<f8"), (f"{column}_count", "<i8")]
+    self.record=np.dtype(fields)
+    self.pending=None
+    self.file=None
+
+  @staticmethod
+  def digest(column_names):
+    return hashlib.sha1(json.dumps(list(column_names)).encode()).hexdigest()[:8]
+
+  def width_ns(self):
+    return self.width*1_000_000_000
+
+  def records(self):
+    try:
+      size=os.path.getsize(self.path)
+    except FileNotFoundError:
+      return np.empty(0, dtype=self.record)
+    if size < self.record.itemsize:
+      return np.empty(0, dtype=self.record)
+    return np.memmap(self.path, dtype=self.record, mode="r", shape=(size//self.record.itemsize,))
+
+  def complete_until(self):
+    records=self.records()
+    return int(records["time"][-1]) + self.width_ns() if len(records)>0 else None
+
+  def resume_time(self):
+    if self.pending is not None:
+      return int(self.pending["time"][0])
+    return self.complete_until()
+
+  def aggregate(self, times, columns):
+    buckets=times - times % self.width_ns()
+    starts=np.concatenate([[0], np.flatnonzero(np.diff(buckets))+1])
+    aggregated=np.empty(len(starts), dtype=self.record)
+    aggregated["time"]=buckets[starts]
+    for column in self.column_names:
+      values=np.asarray(columns[column], dtype=np.float64)
+      valid=~np.isnan(values)
+      aggregated[f"{column}_min"]=np.fmin.reduceat(values, starts)
+      aggregated[f"{column}_max"]=np.fmax.reduceat(values, starts)
+      aggregated[f"{column}_sum"]=np.add.reduceat(np.where(valid, values, 0.0), starts)
+      aggregated[f"{column}_count"]=np.add.reduceat(valid.astype(np.int64), starts)
+    return aggregated
+
+  def merge(self, a, b):
+    merged=a.copy()
+    for column in self.column_names:
+      merged[f"{column}_min"]=np.fmin(a[f"{column}_min"], b[f"{column}_min"])
+      merged[f"{column}_max"]=np.fmax(a[f"{column}_max"], b[f"{column}_max"])
+      merged[f"{column}_sum"]=a[f"{column}_sum"] + b[f"{column}_sum"]
+      merged[f"{column}_count"]=a[f"{column}_count"] + b[f"{column}_count"]
+    return merged
+
+  def extend(self, times, columns):
+    resume=self.resume_time()
+    if resume is not None:
+      keep=times >= resume
+      times=times[keep]
+      columns={column:np.asarray(columns[column])[keep] for column in self.column_names}
+    if len(times) == 0:
+      return
+    aggregated=self.aggregate(times, columns)
+    if self.pending is not None and self.pending["time"][0] == aggregated["time"][0]:
+      aggregated[:1]=self.merge(self.pending, aggregated[:1])
+    elif self.pending is not None:
+      aggregated=np.concatenate([self.pending, aggregated])
+    self.write(aggregated[:-1])
+    self.pending=aggregated[-1:].copy()
+
+  def write(self, records):
+    if len(records) == 0:
+      return
+    if self.file is None:
+      self.file=open(self.path, "ab")
+      size=self.file.tell()
+      if size % self.record.itemsize != 0:
+        print(f"{self.path} ends with a partial record, truncating it.")
+        self.file.truncate(size - size % self.record.itemsize)
+    self.file.write(records.tobytes())
+    self.file.flush()
+
+  def sync(self):
+    if self.file is not None:
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file=None
+    self.pending=None
+
+  def dataframe(self, records, columns=None):
+    # The mean of each column under its own name, next to <column>_min, _max and _count. The means come
+    # last, a column of the archive named like the statistic of another one keeps its name.
+    columns=columns if columns is not None else self.column_names
+    frame={}
+    for column in columns:
+      frame[f"{column}_min"]=records[f"{column}_min"]
+      frame[f"{column}_max"]=records[f"{column}_max"]
+      frame[f"{column}_count"]=records[f"{column}_count"]
+    for column in columns:
+      count=records[f"{column}_count"]
+      with np.errstate(invalid="ignore", divide="ignore"):
+        frame[column]=np.where(count>0, records[f"{column}_sum"]/count, np.nan)
+    return pd.DataFrame(frame, index=pd.DatetimeIndex(np.asarray(records["time"]).view("datetime64[ns]"), name="time"))
+
+  def read_span(self, start, end):
+    records=self.records()
+    start_ns=np.datetime64(start, "ns").astype(np.int64) - self.width_ns() + 1
+    end_ns=np.datetime64(end, "ns").astype(np.int64)
+    first=np.searchsorted(records["time"], start_ns, side="left")
+    last=np.searchsorted(records["time"], end_ns, side="right")
+    return records[first:last]
+
+class Rollups:
+  Tiers=[("minute", 60), ("hour", 60*60), ("day", 24*60*60)]
+  Statistics=["min", "max", "count"]
+
+  def __init__(self, directory, column_names):
+    self.directory=directory
+    self.column_names=column_names
+    self.tiers={name:RollupTier(directory, name, width, column_names) for name, width in self.Tiers}
+
+  def remove_stale(self):
+    # Tiers of other columns, left behind when the sensors were changed
+    paths=[tier.path for tier in self.tiers.values()]
+    for name in os.listdir(self.directory):
+      path=os.path.join(self.directory, name)
+      if name.startswith("rollup.") and path not in paths:
+        print(f"Removing {path}, its columns are not those of the archive")
+        os.remove(path)
+
+  def resume_time(self):
+    resume_times=[tier.resume_time() for tier in self.tiers.values()]
+    return None if None in resume_times else min(resume_times)
+
+  def extend(self, times, columns):
+    for tier in self.tiers.values():
+      tier.extend(times, columns)
+
+  def append(self, measurement, time):
+    self.extend(np.array([np.datetime64(time, "ns").astype(np.int64)]),
+                {column:np.array([value], dtype=np.float64) for column, value in zip(self.column_names, measurement)})
+
+  def catch_up(self, archive):
+    # Rebuilds whatever the tiers are missing (including the unsaved current buckets) from raw samples
+    resume=self.resume_time()
+    start=pd.Timestamp(resume).to_pydatetime() if resume is not None else datetime.datetime.min
+    for entry in archive.entries_in_span(start, datetime.datetime.max):
+      time, columns=entry.read_span(max(start, entry.start), entry.end, self.column_names)
+      self.extend(time, columns)
+
+  def sync(self):
+    for tier in self.tiers.values():
+      tier.sync()
+
+  def close(self):
+    for tier in self.tiers.values():
+      tier.close()
+
+  def tier_for(self, start, end, max_points):
+    # The finest tier which fits the budget, or the coarsest one if none does
+    span=(end-start).total_seconds()
+    for name, width in self.Tiers:
+      if span/width <= max_points:
+        return name
+    return self.Tiers[-1][0]
+
+  def columns_of(self, columns):
+    # The columns the given ones are statistics of, or are themselves
+    rolled_up=[]
+    for column in columns:
+      if column not in self.column_names:
+        column=next((c for c in self.column_names for statistic in self.Statistics if column == f"{c}_{statistic}"), column)
+      if column not in rolled_up:
+        rolled_up.append(column)
+    return rolled_up
+
+  def read_span(self, tier_name, start, end, archive, columns=None):
+    tier=self.tiers[tier_name]
+    records=tier.read_span(start, end)
+    # Buckets the measurer has not written out yet are aggregated from raw samples
+    complete_until=tier.complete_until()
+    recent_start=max(start, pd.Timestamp(complete_until).to_pydatetime()) if complete_until is not None else start
+    if recent_start <= end:
+      spans=[entry.read_span(recent_start, end, self.column_names) for entry in archive.entries_in_span(recent_start, end)]
+      times=np.concatenate([np.empty(0, dtype=np.int64)] + [time for time, _ in spans])
+      if len(times)>0:
+        values={column:np.concatenate([span_columns[column] for _, span_columns in spans]) for column in self.column_names}
+        records=np.concatenate([records, tier.aggregate(times, values)])
+    return tier.dataframe(records, columns)
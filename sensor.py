@@ -1 +1,159 @@
-from sensor_scd4x import Sensor_SCD4X as Sensor
+import asyncio, importlib, math, os, time
+
+import numpy as np
+
+class SensorSet:
+  # Several sensors polled concurrently, each at its own period, merged into one row.
+  # With a single sensor its columns keep their names, with several they are prefixed by the sensor.
+  Backends = {
+    "scd4x":("sensor_scd4x", "Sensor_SCD4X"),
+    "bme280":("sensor_bme280", "Sensor_BME280"),
+  }
+  Members = []
+  Parameters = []
+  Decorations = {}
+  # Archive columns, with aggregation the parameters hold means and are followed by their statistics
+  Aggregated = False
+  Columns = []
+
+  class Member:
+    def __init__(self, name, backend, period):
+      self.name = name
+      self.backend = backend
+      self.period = period
+      self.sensor = None
+      self.due = False
+      # The first read is due straight away, the following ones a period apart
+      self.next_read = time.monotonic()
+
+    def columns(self):
+      return len(self.backend.Parameters)
+
+  class Aggregate:
+    # Mean, min, max and population standard deviation of each parameter over the samples added since
+    # the last reset, using Welford's running update. Missing values are skipped.
+    Statistics = ["min", "max", "std"]
+
+    def __init__(self, size):
+      self.size = size
+      self.reset()
+
+    def reset(self):
+      self.count = np.zeros(self.size)
+      self.mean = np.zeros(self.size)
+      self.m2 = np.zeros(self.size)
+      self.min = np.full(self.size, np.nan)
+      self.max = np.full(self.size, np.nan)
+
+    def add(self, measurement):
+      values = np.asarray(measurement, dtype=np.float64)
+      valid = ~np.isnan(values)
+      self.count += valid
+      delta = np.where(valid, values - self.mean, 0.0)
+      self.mean += delta/np.maximum(self.count, 1)
+      self.m2 += np.where(valid, delta*(values - self.mean), 0.0)
+      self.min = np.fmin(self.min, values)
+      self.max = np.fmax(self.max, values)
+
+    def measurement(self):
+      # In the order of SensorSet.Columns, NaN for parameters which had no samples
+      with np.errstate(invalid="ignore", divide="ignore"):
+        sampled = self.count > 0
+        mean = np.where(sampled, self.mean, np.nan)
+        std = np.where(sampled, np.sqrt(self.m2/self.count), np.nan)
+      return mean.tolist() + np.column_stack([self.min, self.max, std]).ravel().tolist()
+
+    @classmethod
+    def columns(cls, parameters):
+      return list(parameters) + [f"{parameter}_{statistic}" for parameter in parameters for statistic in cls.Statistics]
+
+  @classmethod
+  def parse(cls, spec):
+    # "scd4x:30,bme280:5" -> [("scd4x", 30.0), ("bme280", 5.0)], a missing period uses the measurer's
+    members = []
+    for item in spec.split(","):
+      name, _, period = item.strip().partition(":")
+      if name not in cls.Backends:
+        raise ValueError(f"Unknown sensor {name}, known sensors are: {', '.join(cls.Backends)}")
+      members.append((name, float(period) if period else None))
+    if len(set(name for name, _ in members)) != len(members):
+      raise ValueError(f"Sensors are listed more than once in {spec}")
+    return members
+
+  @classmethod
+  def from_spec(cls, spec, aggregate=False):
+    members = []
+    for name, period in cls.parse(spec):
+      module, class_name = cls.Backends[name]
+      members.append((name, getattr(importlib.import_module(module), class_name), period))
+
+    if len(members) == 1:
+      _, backend, _ = members[0]
+      parameters = backend.Parameters
+      decorations = backend.Decorations
+    else:
+      parameters = []
+      decorations = {}
+      displayed = set()
+      for name, backend, _ in members:
+        for parameter in backend.Parameters:
+          parameters.append(f"{name}_{parameter}")
+          decoration = dict(backend.Decorations[parameter], name=f"{backend.Decorations[parameter]['name']} ({name})")
+          # The LCD has room for few custom characters, so it shows each quantity of the first sensor only
+          if parameter in displayed:
+            decoration.pop("display", None)
+          displayed.add(parameter)
+          decorations[f"{name}_{parameter}"] = decoration
+
+    columns = cls.Aggregate.columns(parameters) if aggregate else parameters
+    return type("Sensor", (cls,), {"Members":members, "Parameters":parameters, "Decorations":decorations,
+                                   "Aggregated":aggregate, "Columns":columns})
+
+  def __init__(self, period=60):
+    self.members = [SensorSet.Member(name, backend, member_period or period) for name, backend, member_period in self.Members]
+    self.period = min(member.period for member in self.members)
+    self.loop = asyncio.new_event_loop()
+    for member in self.members:
+      member.sensor = member.backend()
+      member.sensor.ensure_started()
+
+  def measure(self, timeout=None):
+    # Polls the sensors which are due and waits at most timeout for those without a result yet. A sensor
+    # which is still not ready is polled again by the next call, sensors without a new reading give NaN.
+    now = time.monotonic()
+    for member in self.members:
+      # The measurer calls on its own deadlines, which may come a little before those of the sensors
+      if not member.due and now >= member.next_read - self.period/2:
+        member.next_read = max(member.next_read, now - member.period) + member.period
+        member.due = True
+    readings = self.loop.run_until_complete(self.read([member for member in self.members if member.due], timeout))
+
+    measurement = []
+    for member in self.members:
+      measurement += readings.get(member, [math.nan]*member.columns())
+    return measurement
+
+  async def read(self, members, timeout):
+    tasks = {asyncio.ensure_future(member.sensor.read()):member for member in members}
+    if not tasks:
+      return {}
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+      task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    readings = {}
+    for task in done:
+      member = tasks[task]
+      member.due = False
+      if task.exception() is not None:
+        print(f"Reading {member.name} failed: {task.exception()}")
+        continue
+      readings[member] = task.result()
+    return readings
+
+  def close(self):
+    self.loop.close()
+
+# Every process reading the archive needs the same settings, they decide its columns
+Sensor = SensorSet.from_spec(os.environ.get("SENSORS") or "scd4x", aggregate=bool(os.environ.get("AGGREGATE")))
@@ -2,7 +2,9 @@ from smbus import SMBus
 from bme280 import BME280
 import time
 
-class Sensor_BME280:
+from polled_sensor import PolledSensor
+
+class Sensor_BME280(PolledSensor):
   Parameters = ["temperature", "humidity", "pressure"]
   Decorations = {
     "temperature":{
@@ -80,14 +82,32 @@ class Sensor_BME280:
     },
   }
 
+  # In normal mode the sensor measures continuously, a measurement with 16x oversampling of all three
+  # values takes up to 113 ms and is followed by the standby time
+  STANDBY = 0.5
+  MEASUREMENT_TIME = 0.113
+  POLL_INTERVAL = 0.05
+  I2C_ADDRESS = 0x76
+  # Bit 3 of the status register is set while a measurement is running
+  STATUS_REGISTER = 0xF3
+  STATUS_MEASURING = 0x08
+
   def __init__(self, smbus=1):
-    bus = SMBus(smbus)
-    self.bme = BME280(i2c_dev=bus)
-    self.bme.update_sensor()
-    time.sleep(2)
-    self.bme.update_sensor()
-    time.sleep(2)
+    self.bus = SMBus(smbus)
+    self.bme = BME280(i2c_addr=self.I2C_ADDRESS, i2c_dev=self.bus)
+    self.next_result = None
+
+  def start(self):
+    self.bme.setup(mode="normal", temperature_standby=int(self.STANDBY*1000))
+    # The result registers hold reset values until the first measurement is complete
+    self.next_result = time.monotonic() + self.MEASUREMENT_TIME
+
+  def data_ready(self):
+    if time.monotonic() < self.next_result:
+      return False
+    return not self.bus.read_byte_data(self.I2C_ADDRESS, self.STATUS_REGISTER) & self.STATUS_MEASURING
 
-  def measure(self):
+  def fetch(self):
     self.bme.update_sensor()
+    self.next_result = time.monotonic() + self.STANDBY
     return [self.bme.temperature, self.bme.humidity, self.bme.pressure]
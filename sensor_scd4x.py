@@ -1,6 +1,8 @@
 from scd4x import SCD4X
 
-class Sensor_SCD4X:
+from polled_sensor import PolledSensor
+
+class Sensor_SCD4X(PolledSensor):
   Parameters = ["temperature", "humidity", "co2"]
   Decorations = {
     "temperature":{
@@ -78,10 +80,18 @@ class Sensor_SCD4X:
     }
   }
 
+  # A new result every 5 seconds in periodic mode
+  POLL_INTERVAL = 0.5
+
   def __init__(self):
     self.scd = SCD4X()
+
+  def start(self):
     self.scd.start_periodic_measurement()
 
-  def measure(self):
+  def data_ready(self):
+    return self.scd.data_ready()
+
+  def fetch(self):
     co2, temperature, rh, _ = self.scd.measure()
     return [temperature, rh, co2]
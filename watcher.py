@@ -0,0 +1,75 @@
+import ctypes, ctypes.util, os, select, struct, threading
+
+IN_CLOEXEC=0o2000000
+IN_NONBLOCK=0o4000
+
+def inotify_watch(path, mask, flags=IN_CLOEXEC):
+  # An inotify file descriptor watching path for the events in mask
+  libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  fd=libc.inotify_init1(flags)
+  if fd < 0:
+    raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+  if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+    error=ctypes.get_errno()
+    os.close(fd)
+    raise OSError(error, f"Cannot watch {path}")
+  return fd
+
+class ArchiveWatcher(threading.Thread):
+  # Watches the archive directory with inotify and tells the archive when its files change,
+  # so MeasurementsArchive.refresh can return straight away while nothing was written.
+  IN_MODIFY=0x00000002
+  IN_CLOSE_WRITE=0x00000008
+  IN_MOVED_FROM=0x00000040
+  IN_MOVED_TO=0x00000080
+  IN_CREATE=0x00000100
+  IN_DELETE=0x00000200
+  IN_Q_OVERFLOW=0x00004000
+  Event=struct.Struct("iIII")
+
+  def __init__(self, archive):
+    threading.Thread.__init__(self, daemon=True)
+    self.archive=archive
+    self.version=0
+    self.stop_event=threading.Event()
+    self.fd=None
+
+  @classmethod
+  def available(cls):
+    return ctypes.util.find_library("c") is not None and hasattr(ctypes.CDLL(ctypes.util.find_library("c")), "inotify_init1")
+
+  def watch(self):
+    mask=self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+    self.fd=inotify_watch(self.archive.archive_path, mask)
+
+  def start(self):
+    self.watch()
+    self.archive.watcher=self
+    threading.Thread.start(self)
+
+  def relevant(self, name):
+    # Temporary files of atomic rewrites are followed by a rename which is reported anyway
+    return not (name.endswith(".tmp") or name.endswith(".old"))
+
+  def run(self):
+    while not self.stop_event.is_set():
+      ready, _, _=select.select([self.fd], [], [], 1)
+      if not ready:
+        continue
+      data=os.read(self.fd, 64*1024)
+      changed=False
+      offset=0
+      while offset < len(data):
+        _, mask, _, length=self.Event.unpack_from(data, offset)
+        name=data[offset+self.Event.size:offset+self.Event.size+length].rstrip(b"\0").decode(errors="replace")
+        offset+=self.Event.size+length
+        changed=changed or mask & self.IN_Q_OVERFLOW or self.relevant(name)
+      if changed:
+        self.version+=1
+        self.archive.changes_pending=True
+    os.close(self.fd)
+
+  def stop(self):
+    self.stop_event.set()
+    if self.archive.watcher is self:
+      self.archive.watcher=None